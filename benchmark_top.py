@@ -0,0 +1,87 @@
+"""
+Сравнение времени сборки рейтингов (/top, /profile) до и после объединения счетов с пользователями по словарю.
+Данные генерируются в памяти, БД не нужна.
+
+Запуск: python benchmark_top.py [количество пользователей ...]
+"""
+import random
+import sys
+import time
+
+import utils
+
+
+def legacy_top_users(users: list[dict], banks: list[dict]) -> list[dict]:
+    # Прежний вариант Storage.get_top_users: O(пользователи × счета).
+    for user_note in users:
+        for bank in banks:
+            if bank["user_id"] == user_note["user_id"]:
+                user_note["balance"] = int(user_note["balance"] + bank["unbankSum"])
+    return users
+
+
+def legacy_top_groups(group_members: list[tuple], banks: list[dict]) -> dict:
+    # Прежний вариант Storage.get_top_groups: для каждого счета перебор групп с поиском владельца
+    # в списке участников, O(счета × группы × участники).
+    groups = {}
+    for user_id, group_id, balance, crystals in group_members:
+        if groups.get(group_id) is None:
+            groups[group_id] = {"members": [], "balance": 0, "crystals": 0}
+        groups[group_id]["members"].append(user_id)
+        groups[group_id]["balance"] += balance
+        groups[group_id]["crystals"] += crystals
+
+    for bank in banks:
+        owner_id = bank["user_id"]
+        now_balance = bank["unbankSum"]
+
+        for group_id in groups.keys():
+            if owner_id in groups[group_id]["members"]:
+                groups[group_id]["balance"] += now_balance
+                break
+
+    return {gid: {"members": len(g["members"]), "balance": g["balance"], "crystals": g["crystals"]}
+            for gid, g in groups.items()}
+
+
+def generate(users_count: int) -> tuple[list[dict], list[dict], list[tuple]]:
+    rnd = random.Random(users_count)
+    user_ids = list(range(1, users_count + 1))
+    users = [{"user_id": user_id, "balance": rnd.randint(0, 100_000)} for user_id in user_ids]
+    # Примерно по счету на пользователя, у части пользователей счетов несколько.
+    banks = [{"user_id": rnd.choice(user_ids), "unbankSum": rnd.randint(50, 50_000)} for _ in range(users_count)]
+
+    member_groups = {user_id: rnd.randint(1, max(users_count // 40, 1))
+                     for user_id in user_ids if rnd.random() < 0.6}
+    group_members = [(user_id, group_id, rnd.randint(0, 100_000), rnd.randint(0, 50))
+                     for user_id, group_id in member_groups.items()]
+    return users, banks, group_members
+
+
+def measure(func, *args) -> tuple[float, object]:
+    started = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def main(sizes: list[int]):
+    print(f"{'users':>8} | {'top users, ms':>22} | {'top groups, ms':>22}")
+    print(f"{'':>8} | {'before':>10} {'after':>11} | {'before':>10} {'after':>11}")
+    for users_count in sizes:
+        users, banks, group_members = generate(users_count)
+
+        legacy_users_ms, legacy_users = measure(legacy_top_users, [dict(u) for u in users], banks)
+        new_users = [dict(u) for u in users]
+        users_ms, _ = measure(utils.add_banks_to_balances, new_users, banks)
+        assert legacy_users == new_users
+
+        legacy_groups_ms, legacy_groups = measure(legacy_top_groups, group_members, banks)
+        groups_ms, new_groups = measure(utils.sum_group_balances, group_members, banks)
+        assert legacy_groups == new_groups
+
+        print(f"{users_count:>8} | {legacy_users_ms:>10.1f} {users_ms:>11.2f} | "
+              f"{legacy_groups_ms:>10.1f} {groups_ms:>11.2f}")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [500, 1000, 2000, 4000, 8000])
@@ -187,9 +187,66 @@ else:
     CHAT_ID: int = 0
 
 
+DB_HOST = "127.0.0.1"
+DB_PORT = 3306
 DB_DATABASE = ""
 DB_USER = ""
 DB_PASSWORD = ""
 
+# Пул соединений с БД.
+# Количество соединений, открываемых сразу при запуске.
+DB_POOL_MINSIZE = 5
+# Максимальное количество соединений.
+DB_POOL_MAXSIZE = 20
+# Время жизни соединения (секунды), -1 - без ограничения.
+DB_POOL_RECYCLE = 3600
+# Максимальное время ожидания свободного соединения (секунды).
+DB_POOL_ACQUIRE_TIMEOUT = 10
+
+# Отложенная запись изменений балансов (монетки и кристаллы копятся в памяти и записываются пачкой).
+BALANCE_BUFFER_ENABLED = False
+# Период сброса накопленных изменений в БД (миллисекунды).
+BALANCE_BUFFER_FLUSH_MS = 500
+# Количество пользователей в буфере, при котором он сбрасывается досрочно.
+BALANCE_BUFFER_MAX_ENTRIES = 100
+
+# Отложенная запись активности в чате (вознаграждение за общение, время последней активности).
+ACTIVITY_BUFFER_ENABLED = True
+# Период сброса накопленной активности в БД (секунды).
+ACTIVITY_BUFFER_FLUSH_SECONDS = 5
+# Количество пользователей в буфере, при котором он сбрасывается досрочно.
+ACTIVITY_BUFFER_MAX_ENTRIES = 200
+# Время последней активности (users.updated) без других изменений записывается в БД не чаще (секунды).
+# Поиск неактивных пользователей использует точное время из памяти.
+LAST_SEEN_FLUSH_SECONDS = 300
+
+# Кэш профилей пользователей.
+# Максимальное количество пользователей в кэше.
+USER_CACHE_MAX_SIZE = 2000
+# Время жизни записи (секунды).
+USER_CACHE_TTL = 300
+# Время жизни кэша групп и их участников (секунды).
+GROUP_CACHE_TTL = 600
+
+# Временные значения пользователей в памяти (кд, черновики и т.п.).
+# Максимальное количество значений.
+LOCAL_STORE_MAX_SIZE = 10_000
+# Время жизни значения по умолчанию (секунды).
+LOCAL_STORE_TTL = 86400
+
+# Закэшированные статусы участников чата.
+# Максимальное количество статусов.
+CHAT_MEMBERS_CACHE_MAX_SIZE = 10_000
+# Время жизни статуса (секунды).
+CHAT_MEMBERS_CACHE_TTL = 600
+
+# Рейтинги (/top, /worst, /profile) поддерживаются в памяти событиями изменения балансов.
+# Период пересчета сумм банковских счетов, проценты по которым начисляются непрерывно (секунды).
+RANKINGS_BANKS_REFRESH_SECONDS = 60
+# Период сверки балансов и кристаллов участников с БД (секунды).
+RANKINGS_RECONCILE_SECONDS = 600
+# Пока рейтинги перечитываются из БД, отдавать прежние значения из памяти (иначе ответ строится по БД).
+RANKINGS_STALE_WHILE_REVALIDATE = True
+
 COMING_SOON_TEXT = "🛠️ В разработке, ожидайте обновлений"
 MAX_INT_UNSIGNED = 4_200_000_000
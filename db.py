@@ -1,16 +1,35 @@
 import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import heapq
+import logging
 import random
+import sys
+import time
+import types
 import typing
-import copy
 
 import aiomysql
 import datetime
 
 import config
-import entities
 import utils
 
 HIGH_LIMIT = 9999
+# Максимальное количество закэшированных текстов запросов.
+STATEMENT_CACHE_SIZE = 256
+# Количество строк, которое забирается с сервера за раз при потоковом чтении.
+STREAM_CHUNK_SIZE = 500
+# Колонки users, из которых собирается профиль пользователя (User.load_from_dict).
+USER_PROFILE_KEYS = (
+    "user_id", "username", "first_name", "last_name", "balance", "crystals", "team_id", "msg_code", "policy",
+    "extra_percent", "protect_level", "banned", "muted", "agreed", "reward_updated", "updated", "created"
+)
+# Колонки users, которые обновляются при активности в чате (кроме баланса).
+ACTIVITY_KEYS = ("username", "first_name", "last_name", "reward_updated", "updated")
 
 
 class Tables:
@@ -65,29 +84,859 @@ class MarketDirection:
     buy = "buy"
 
 
+class Row(tuple):
+    """
+    Строка выборки: кортеж с доступом к колонкам по имени (row.balance, row["balance"], row.get("balance")).
+    Конкретные типы строк создаются Storage._row_type для каждого набора колонок.
+    """
+    __slots__ = ()
+    _fields: tuple = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def keys(self) -> tuple:
+        return self._fields
+
+
+class PoolStats:
+    """Счетчики использования пула соединений."""
+    def __init__(self):
+        self.acquired = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def on_acquire(self, wait: float):
+        self.acquired += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def on_release(self):
+        self.in_use -= 1
+
+
+class QueryStats:
+    """Время выполнения, количество вызовов и строк для каждого метода Storage."""
+    # Границы корзин гистограммы времени выполнения (миллисекунды).
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self.sites: dict[str, dict] = {}
+        self.updates: dict[str, dict] = {}
+        # Запросы single_flight: выполненные и присоединившиеся к уже выполняющемуся.
+        self.flights = 0
+        self.shared_flights = 0
+
+    def record_query(self, site: str, elapsed: float, rows: int):
+        info = self.sites.get(site)
+        if info is None:
+            info = self.sites[site] = {
+                "calls": 0,
+                "rows": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "buckets": [0] * (len(self.BUCKETS_MS) + 1)
+            }
+
+        elapsed_ms = elapsed * 1000
+        info["calls"] += 1
+        info["rows"] += max(rows, 0)
+        info["total_ms"] += elapsed_ms
+        info["max_ms"] = max(info["max_ms"], elapsed_ms)
+
+        bucket = len(self.BUCKETS_MS)
+        for idx, edge in enumerate(self.BUCKETS_MS):
+            if elapsed_ms <= edge:
+                bucket = idx
+                break
+        info["buckets"][bucket] += 1
+
+    def record_update(self, label: str, queries: int):
+        info = self.updates.get(label)
+        if info is None:
+            info = self.updates[label] = {
+                "updates": 0,
+                "queries": 0,
+                "max_queries": 0
+            }
+
+        info["updates"] += 1
+        info["queries"] += queries
+        info["max_queries"] = max(info["max_queries"], queries)
+
+    def percentile_ms(self, site: str, percent: int) -> int | None:
+        """Верхняя граница корзины, в которую попадает заданный процентиль (None - больше последней)."""
+        info = self.sites[site]
+        threshold = info["calls"] * percent / 100
+        passed = 0
+        for idx, count in enumerate(info["buckets"]):
+            passed += count
+            if passed >= threshold:
+                return self.BUCKETS_MS[idx] if idx < len(self.BUCKETS_MS) else None
+
+    def top_sites(self, limit: int = 10) -> list[tuple[str, dict]]:
+        return sorted(self.sites.items(), key=lambda x: x[1]["total_ms"], reverse=True)[:limit]
+
+    def top_updates(self, limit: int = 10) -> list[tuple[str, dict]]:
+        return sorted(self.updates.items(), key=lambda x: x[1]["queries"] / x[1]["updates"], reverse=True)[:limit]
+
+
+class UserCache:
+    """
+    Кэш профилей пользователей (строки users с колонками USER_PROFILE_KEYS) по user_id
+    с дополнительным индексом по username / msg_code.
+    Запись живет не дольше ttl секунд, при переполнении вытесняется давно не использованная.
+    Строки хранятся в том виде, в каком они записаны в БД (без отложенных изменений балансов).
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        # {user_id: (время истечения, строка)}, порядок - от давно использованных к недавним.
+        self.rows: collections.OrderedDict[int, tuple[float, Row]] = collections.OrderedDict()
+        self.names: dict[str, int] = {}
+        # Меняется при каждой инвалидации. Строка, прочитанная из БД до изменения, в кэш не попадет.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _names(row: Row) -> tuple:
+        return tuple(name.lower() for name in (row.username, row.msg_code) if name)
+
+    def _drop(self, user_id: int):
+        entry = self.rows.pop(user_id, None)
+        if entry is not None:
+            for name in self._names(entry[1]):
+                if self.names.get(name) == user_id:
+                    del self.names[name]
+
+    def get(self, user_id: int) -> Row | None:
+        entry = self.rows.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self._drop(user_id)
+            self.misses += 1
+            return None
+
+        self.rows.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def get_by_name(self, name: str) -> Row | None:
+        user_id = self.names.get(name.lower())
+        if user_id is None:
+            self.misses += 1
+            return None
+        return self.get(user_id)
+
+    def put(self, row: Row, generation: int):
+        """:param generation: значение self.generation на момент начала чтения строки из БД."""
+        if generation != self.generation:
+            return
+
+        self._drop(row.user_id)
+        self.rows[row.user_id] = (time.monotonic() + self.ttl, row)
+        for name in self._names(row):
+            self.names[name] = row.user_id
+
+        while len(self.rows) > self.max_size:
+            self._drop(next(iter(self.rows)))
+
+    def invalidate(self, *user_ids: int):
+        self.generation += 1
+        for user_id in user_ids:
+            self._drop(user_id)
+
+    def team_members(self, team_id: int) -> list[int]:
+        return [user_id for user_id, (_, row) in self.rows.items() if row.team_id == team_id]
+
+    def add_balances(self, deltas: dict[int, list[int]], entries: dict[int, tuple[float, Row]]):
+        """
+        Переносит в закэшированные строки изменения балансов, записанные в БД.
+        :param entries: записи кэша на момент начала записи (см. add_activity).
+        """
+        self.generation += 1
+        for user_id, (coins, crystals) in deltas.items():
+            entry = self.rows.get(user_id)
+            if entry is not None and entry is not entries.get(user_id):
+                self._drop(user_id)
+            elif entry is not None:
+                row = entry[1]
+                self.rows[user_id] = (entry[0], row._replace(balance=row.balance + coins,
+                                                             crystals=row.crystals + crystals))
+
+    def entries(self, user_ids: typing.Iterable[int]) -> dict[int, tuple[float, Row]]:
+        """Текущие записи кэша: по ним после записи в БД видно, какие строки не перечитывались."""
+        return {user_id: self.rows[user_id] for user_id in user_ids if user_id in self.rows}
+
+    def add_activity(self, activity: dict[int, dict], entries: dict[int, tuple[float, Row]]):
+        """
+        Переносит в закэшированные строки вознаграждения и отметки активности, записанные в БД.
+        :param entries: записи кэша на момент начала записи (self.entries). Строки, прочитанные
+                        во время записи, могли уже включать изменения, поэтому они сбрасываются.
+        """
+        self.generation += 1
+        for user_id, changes in activity.items():
+            entry = self.rows.get(user_id)
+            if entry is not None and entry is not entries.get(user_id):
+                self._drop(user_id)
+            elif entry is not None:
+                row = entry[1]._replace(balance=entry[1].balance + changes["reward"],
+                                        **{k: changes[k] for k in ACTIVITY_KEYS})
+                # При смене имени проще перечитать строку, чем перестраивать индекс имен.
+                if self._names(row) != self._names(entry[1]):
+                    self._drop(user_id)
+                else:
+                    self.rows[user_id] = (entry[0], row)
+
+    def get_info(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self.rows),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests * 100, 1) if requests else 0
+        }
+
+
+class GroupCache:
+    """
+    Кэш таблицы teams (она небольшая, поэтому хранится целиком) и индекса участников team_id -> ID участников.
+    Загружается при первом обращении, сбрасывается при изменении групп или их состава и живет не дольше ttl.
+    """
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.teams: dict[int, dict] = {}
+        self.members: dict[int, frozenset[int]] = {}
+        # Обратный индекс: user_id -> team_id.
+        self.member_groups: dict[int, int] = {}
+        self.expires = 0.0
+        # Меняется при каждой инвалидации. Данные, прочитанные до изменения, не считаются актуальными.
+        self.generation = 0
+        self.hits = 0
+        self.loads = 0
+
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+    def load(self, teams: typing.Iterable[dict], memberships: typing.Iterable[Row], generation: int):
+        members = {}
+        for user_id, team_id in memberships:
+            members.setdefault(team_id, set()).add(user_id)
+
+        self.teams = {team["team_id"]: team for team in teams}
+        self.members = {team_id: frozenset(ids) for team_id, ids in members.items()}
+        self.member_groups = {user_id: team_id for team_id, ids in members.items() for user_id in ids}
+        self.loads += 1
+
+        # Если во время загрузки группы менялись, данные используются один раз и будут перечитаны.
+        self.expires = time.monotonic() + self.ttl if generation == self.generation else 0.0
+
+    def invalidate(self):
+        self.generation += 1
+        self.expires = 0.0
+
+    def get_info(self) -> dict:
+        return {
+            "teams": len(self.teams),
+            "members": len(self.member_groups),
+            "hits": self.hits,
+            "loads": self.loads
+        }
+
+
+class BankRates:
+    """
+    Ставка по банковским счетам каждого пользователя (% в день):
+    BET_BANK_DAILY_DEFAULT + extra_percent + уровень группы.
+    Загружается из БД при первом обращении, дальше поддерживается изменениями (улучшение счета,
+    вступление в группу и выход из нее, смена уровня группы) без повторного пересчета всех ставок.
+    """
+    def __init__(self):
+        self.loaded = False
+        # Меняется при каждом изменении. Данные, прочитанные до изменения, используются один раз.
+        self.generation = 0
+        self.rates: dict[int, int] = {}
+        self.extra: dict[int, int] = {}
+        self.user_teams: dict[int, int] = {}
+        self.levels: dict[int, int] = {}
+        self.members: dict[int, set[int]] = {}
+
+    def load(self, users: typing.Iterable[Row], teams: typing.Iterable[Row], generation: int):
+        self.levels = {team_id: level for team_id, level in teams}
+        self.extra = {}
+        self.user_teams = {}
+        self.members = {}
+        for user_id, team_id, extra_percent in users:
+            self.extra[user_id] = extra_percent
+            if team_id:
+                self.user_teams[user_id] = team_id
+                self.members.setdefault(team_id, set()).add(user_id)
+        self.rates = {user_id: self._calc_rate(user_id) for user_id in self.extra}
+        self.loaded = generation == self.generation
+
+    def _calc_rate(self, user_id: int) -> int:
+        extra_group_percent = self.levels.get(self.user_teams.get(user_id), 0)
+        return int(self.extra.get(user_id, 0) + config.BET_BANK_DAILY_DEFAULT + extra_group_percent)
+
+    def rate(self, user_id: int) -> int:
+        return self.rates.get(user_id, config.BET_BANK_DAILY_DEFAULT)
+
+    def add_extra(self, user_id: int, delta: int):
+        self.generation += 1
+        if self.loaded:
+            self.extra[user_id] = self.extra.get(user_id, 0) + delta
+            self.rates[user_id] = self._calc_rate(user_id)
+
+    def set_team(self, user_id: int, team_id: int | None):
+        self.generation += 1
+        if self.loaded:
+            old_team_id = self.user_teams.pop(user_id, None)
+            if old_team_id is not None:
+                self.members.get(old_team_id, set()).discard(user_id)
+            if team_id:
+                self.user_teams[user_id] = team_id
+                self.members.setdefault(team_id, set()).add(user_id)
+            self.rates[user_id] = self._calc_rate(user_id)
+
+    def set_level(self, team_id: int, level: int):
+        self.generation += 1
+        if self.loaded:
+            self.levels[team_id] = level
+            for user_id in self.members.get(team_id, ()):
+                self.rates[user_id] = self._calc_rate(user_id)
+
+    def remove_team(self, team_id: int):
+        """Все участники группы выходят из нее."""
+        self.generation += 1
+        if self.loaded:
+            for user_id in self.members.pop(team_id, ()):
+                self.user_teams.pop(user_id, None)
+                self.rates[user_id] = self._calc_rate(user_id)
+
+    def invalidate(self):
+        self.generation += 1
+        self.loaded = False
+
+
+class ExpiringStore:
+    """
+    Хранилище значений вида (владелец, ключ) -> значение с временем жизни каждого значения
+    и вытеснением давно не использованных при переполнении.
+    Значения приводятся к неизменяемому виду (list -> tuple, dict -> MappingProxyType, set -> frozenset),
+    поэтому копировать их при записи и чтении не нужно.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        # {(владелец, ключ): (время истечения, значение)}, порядок - от давно использованных к недавним.
+        self.box: collections.OrderedDict[tuple, tuple[float, typing.Any]] = collections.OrderedDict()
+        self.owners: dict[typing.Hashable, set] = {}
+        self.evicted = 0
+        self.expired = 0
+
+    @staticmethod
+    def freeze(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(ExpiringStore.freeze(v) for v in value)
+        if isinstance(value, dict):
+            return types.MappingProxyType({k: ExpiringStore.freeze(v) for k, v in value.items()})
+        if isinstance(value, set):
+            return frozenset(value)
+        return value
+
+    def _drop(self, owner, key):
+        if self.box.pop((owner, key), None) is not None:
+            keys = self.owners[owner]
+            keys.discard(key)
+            if not keys:
+                del self.owners[owner]
+
+    def get(self, owner, key: str, default=None):
+        entry = self.box.get((owner, key))
+        if entry is None:
+            return default
+
+        if entry[0] < time.monotonic():
+            self._drop(owner, key)
+            self.expired += 1
+            return default
+
+        self.box.move_to_end((owner, key))
+        return entry[1]
+
+    def set(self, owner, key: str, value, ttl: int | None = None):
+        """:param ttl: время жизни значения (секунды), по умолчанию - общее для хранилища."""
+        self.box[(owner, key)] = (time.monotonic() + (ttl or self.ttl), self.freeze(value))
+        self.box.move_to_end((owner, key))
+        self.owners.setdefault(owner, set()).add(key)
+
+        while len(self.box) > self.max_size:
+            self._drop(*next(iter(self.box)))
+            self.evicted += 1
+
+    def delete(self, owner, key: str):
+        self._drop(owner, key)
+
+    def reset(self, owner):
+        for key in list(self.owners.get(owner, ())):
+            self._drop(owner, key)
+
+    def purge_expired(self) -> int:
+        now = time.monotonic()
+        expired = [owner_key for owner_key, (expires, _) in self.box.items() if expires < now]
+        for owner_key in expired:
+            self._drop(*owner_key)
+        self.expired += len(expired)
+        return len(expired)
+
+    def get_info(self) -> dict:
+        # Приблизительная оценка: контейнеры, ключи и значения (без вложенных объектов).
+        memory = sys.getsizeof(self.box) + sys.getsizeof(self.owners)
+        for (owner, key), entry in self.box.items():
+            memory += sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(entry[1])
+        for owner, keys in self.owners.items():
+            memory += sys.getsizeof(owner) + sys.getsizeof(keys)
+
+        return {
+            "size": len(self.box),
+            "max_size": self.max_size,
+            "owners": len(self.owners),
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "memory_kb": round(memory / 1024, 1)
+        }
+
+
+class CooldownIndex:
+    """
+    Время последних обнимашек, жалоб, опросов и голоса в опросах - все, что нужно для проверок кд.
+    Загружается из БД при запуске (Storage.load_cooldowns) и дополняется при каждой записи.
+    Хранятся только записи в пределах окна кд: более старые на проверки не влияют.
+    """
+    def __init__(self):
+        self.loaded = False
+        # from_id -> время последних обнимашек.
+        self.hugs: dict[int, datetime.datetime] = {}
+        # (from_id, to_id) -> время последних обнимашек.
+        self.hug_pairs: dict[tuple[int, int], datetime.datetime] = {}
+        # from_id -> [(время, to_id)] жалоб.
+        self.reports: dict[int, list[tuple[datetime.datetime, int]]] = {}
+        # poll_id -> {"to_id", "created", "stage"}.
+        self.polls: dict[int, dict] = {}
+        # (poll_id, stage, user_id) проголосовавших.
+        self.votes: set[tuple[int, int, int]] = set()
+
+    @staticmethod
+    def hugs_window() -> datetime.timedelta:
+        return datetime.timedelta(seconds=max(config.COOLDOWN_FROM_HUG, config.COOLDOWN_FROM_HUG_SAME))
+
+    @staticmethod
+    def reports_window() -> datetime.timedelta:
+        return datetime.timedelta(seconds=config.COOLDOWN_REPORT)
+
+    @staticmethod
+    def polls_window() -> datetime.timedelta:
+        return datetime.timedelta(seconds=max(config.COOLDOWN_USER_POLL, config.TIME_TO_POLL))
+
+    def add_hug(self, from_id: int, to_id: int, created: datetime.datetime):
+        if created > self.hugs.get(from_id, created.min):
+            self.hugs[from_id] = created
+        if created > self.hug_pairs.get((from_id, to_id), created.min):
+            self.hug_pairs[(from_id, to_id)] = created
+
+    def add_report(self, from_id: int, to_id: int, created: datetime.datetime):
+        self.reports.setdefault(from_id, []).append((created, to_id))
+
+    def remove_reports_to(self, to_id: int):
+        for from_id in list(self.reports):
+            reports = [report for report in self.reports[from_id] if report[1] != to_id]
+            if reports:
+                self.reports[from_id] = reports
+            else:
+                del self.reports[from_id]
+
+    def last_report(self, from_id: int) -> datetime.datetime | None:
+        reports = self.reports.get(from_id)
+        return max(reports)[0] if reports else None
+
+    def add_poll(self, poll_id: int, to_id: int, created: datetime.datetime, stage: int = 1):
+        self.polls[poll_id] = {
+            "poll_id": poll_id,
+            "to_id": to_id,
+            "created": created,
+            "stage": stage
+        }
+
+    def last_poll(self, to_id: int, stage: int | None = None) -> dict | None:
+        polls = [poll for poll in self.polls.values()
+                 if poll["to_id"] == to_id and (stage is None or poll["stage"] == stage)]
+        return max(polls, key=lambda poll: poll["poll_id"]) if polls else None
+
+    def purge(self, now: datetime.datetime):
+        """Удаляет записи, которые вышли за окно кд."""
+        hugs_since = now - self.hugs_window()
+        self.hugs = {k: v for k, v in self.hugs.items() if v >= hugs_since}
+        self.hug_pairs = {k: v for k, v in self.hug_pairs.items() if v >= hugs_since}
+
+        reports_since = now - self.reports_window()
+        reports = {}
+        for from_id, items in self.reports.items():
+            items = [item for item in items if item[0] >= reports_since]
+            if items:
+                reports[from_id] = items
+        self.reports = reports
+
+        polls_since = now - self.polls_window()
+        self.polls = {k: v for k, v in self.polls.items() if v["created"] >= polls_since}
+        self.votes = {vote for vote in self.votes if vote[0] in self.polls}
+
+
+class LastSeenIndex:
+    """
+    Время последней активности незаблокированных пользователей для поиска неактивных.
+    Min-куча (время, user_id) с ленивым удалением: запись кучи, время которой не совпадает
+    с последним известным временем пользователя, устарела и отбрасывается при извлечении.
+    """
+    def __init__(self):
+        self.loaded = False
+        self.seen: dict[int, datetime.datetime] = {}
+        self.heap: list[tuple[datetime.datetime, int]] = []
+
+    def load(self, rows: typing.Iterable[Row]):
+        self.seen = {user_id: updated for user_id, updated in rows if updated is not None}
+        self.heap = [(updated, user_id) for user_id, updated in self.seen.items()]
+        heapq.heapify(self.heap)
+        self.loaded = True
+
+    def touch(self, user_id: int, seen: datetime.datetime | None):
+        if not self.loaded or seen is None or self.seen.get(user_id) == seen:
+            return
+
+        self.seen[user_id] = seen
+        heapq.heappush(self.heap, (seen, user_id))
+        # Устаревших записей накопилось больше, чем актуальных - перестраиваем кучу.
+        if len(self.heap) > 2 * len(self.seen) + 1000:
+            self.heap = [(updated, user_id) for user_id, updated in self.seen.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, user_id: int):
+        self.seen.pop(user_id, None)
+
+    def inactive(self, since: datetime.datetime) -> list[int]:
+        """ID пользователей, которые не были активны с since (от давно неактивных к недавним)."""
+        expired = []
+        while self.heap and self.heap[0][0] < since:
+            seen, user_id = heapq.heappop(self.heap)
+            if self.seen.get(user_id) == seen:
+                expired.append((seen, user_id))
+
+        # Пока пользователь не заблокирован, он остается в куче и попадет в следующую выборку.
+        for entry in expired:
+            heapq.heappush(self.heap, entry)
+        return [user_id for _, user_id in expired]
+
+
+class RankIndex:
+    """
+    Места пользователей по значению (состояние, баланс или кристаллы, см. Rankings): отсортированный
+    список (-значение, user_id) и словарь user_id -> значение. Место ищется бинарным поиском за O(log n).
+    Изменение значения (set / add / remove) стоит O(n): bisect.insort и del сдвигают элементы списка.
+    Это происходит на каждое событие BalanceEvent, в том числе на вознаграждение за сообщение.
+    Заполняется целиком при загрузке и пересчете рейтингов (load_rankings, refresh_rankings).
+    """
+    def __init__(self):
+        self.loaded = False
+        self.wealth: dict[int, int] = {}
+        self.keys: list[tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def load(self, users: typing.Iterable[tuple[int, int]]):
+        self.wealth = dict(users)
+        self.keys = sorted((-wealth, user_id) for user_id, wealth in self.wealth.items())
+        self.loaded = True
+
+    def _remove_key(self, user_id: int) -> int | None:
+        wealth = self.wealth.pop(user_id, None)
+        if wealth is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-wealth, user_id))]
+        return wealth
+
+    def set(self, user_id: int, wealth: int):
+        if not self.loaded:
+            return
+        self._remove_key(user_id)
+        self.wealth[user_id] = wealth
+        bisect.insort(self.keys, (-wealth, user_id))
+
+    def add(self, user_id: int, delta: int):
+        """Сдвигает состояние пользователя, если он участвует в рейтинге."""
+        if self.loaded and delta and user_id in self.wealth:
+            self.set(user_id, self.wealth[user_id] + int(delta))
+
+    def remove(self, user_id: int):
+        if self.loaded:
+            self._remove_key(user_id)
+
+    def place(self, user_id: int) -> int | None:
+        wealth = self.wealth.get(user_id)
+        if wealth is None:
+            return None
+        return bisect.bisect_left(self.keys, (-wealth, user_id)) + 1
+
+    def top(self, limit: int | None = None) -> list[int]:
+        """Значения по убыванию (все или первые limit)."""
+        return [-wealth for wealth, _ in self.keys[:limit]]
+
+    def bottom(self, limit: int) -> list[int]:
+        """limit наименьших значений по возрастанию."""
+        return [-wealth for wealth, _ in reversed(self.keys[-limit:])] if limit else []
+
+
+class BalanceEventKind:
+    # Изменение балансов участника рейтинга.
+    change = "change"
+    # Пользователь стал участником рейтинга (значения события - его текущие балансы).
+    add = "add"
+    # Пользователь выбыл из рейтинга.
+    remove = "remove"
+
+
+class BalanceEvent(typing.NamedTuple):
+    """Изменение балансов пользователя, о котором Storage уведомляет подписчиков (balance_listeners)."""
+    user_id: int
+    coins: int = 0
+    crystals: int = 0
+    # Изменение суммы банковских счетов.
+    banks: int = 0
+    kind: str = BalanceEventKind.change
+
+
+class Rankings:
+    """
+    Рейтинги участников (banned = 0, agreed = 1) в памяти: по состоянию (баланс + счета), по балансу
+    и по кристаллам. Загружаются из БД один раз, дальше поддерживаются событиями BalanceEvent,
+    поэтому топ и антитоп отдаются без выборок по таблице.
+    Проценты по счетам начисляются без событий, поэтому суммы счетов периодически пересчитываются
+    (refresh_banks), а балансы сверяются с БД (reconcile).
+    """
+    def __init__(self):
+        self.wealth = RankIndex()
+        self.coins = RankIndex()
+        self.crystals = RankIndex()
+        # Сумма счетов участника: wealth = coins + bank_totals.
+        self.bank_totals: dict[int, int] = {}
+        # Меняется при каждом событии: загрузка, во время которой были события, повторяется.
+        self.generation = 0
+        # Пользователи, по которым были события во время пересчета (None - пересчет не идет).
+        # Их значения из БД могли не учесть эти события, поэтому при пересчете они не меняются.
+        self.touched: set[int] | None = None
+        # Рейтинги нужно перечитать из БД (после отмененной транзакции), до тех пор они устаревшие.
+        self.stale = False
+
+    @property
+    def loaded(self) -> bool:
+        return self.wealth.loaded and self.coins.loaded and self.crystals.loaded
+
+    @property
+    def fresh(self) -> bool:
+        return self.loaded and not self.stale
+
+    def load(self, users: typing.Iterable[tuple[int, int, int]], bank_totals: dict[int, int]):
+        """:param users: (user_id, balance, crystals) участников рейтинга."""
+        users = list(users)
+        self.bank_totals = {user_id: bank_totals.get(user_id, 0) for user_id, _, _ in users}
+        self.wealth.load((user_id, balance + self.bank_totals[user_id]) for user_id, balance, _ in users)
+        self.coins.load((user_id, balance) for user_id, balance, _ in users)
+        self.crystals.load((user_id, crystals) for user_id, _, crystals in users)
+        self.stale = False
+
+    def apply(self, event: BalanceEvent):
+        self.generation += 1
+        if self.touched is not None:
+            self.touched.add(event.user_id)
+
+        if event.kind == BalanceEventKind.remove:
+            for index in (self.wealth, self.coins, self.crystals):
+                index.remove(event.user_id)
+            self.bank_totals.pop(event.user_id, None)
+
+        elif event.kind == BalanceEventKind.add:
+            if self.loaded and event.user_id not in self.coins.wealth:
+                self.bank_totals[event.user_id] = event.banks
+                self.wealth.set(event.user_id, event.coins + event.banks)
+                self.coins.set(event.user_id, event.coins)
+                self.crystals.set(event.user_id, event.crystals)
+
+        else:
+            if event.banks and event.user_id in self.bank_totals:
+                self.bank_totals[event.user_id] += event.banks
+            self.wealth.add(event.user_id, event.coins + event.banks)
+            self.coins.add(event.user_id, event.coins)
+            self.crystals.add(event.user_id, event.crystals)
+
+    def begin_refresh(self):
+        self.touched = set()
+
+    def end_refresh(self):
+        self.touched = None
+
+    def refresh_banks(self, bank_totals: dict[int, int]):
+        """Обновляет суммы счетов участников (кроме тех, по кому были события во время пересчета)."""
+        touched = self.touched or set()
+        for user_id in self.bank_totals:
+            if user_id not in touched:
+                self.bank_totals[user_id] = bank_totals.get(user_id, 0)
+        self.wealth.load((user_id, balance + self.bank_totals[user_id])
+                         for user_id, balance in self.coins.wealth.items())
+
+    def reconcile(self, users: typing.Iterable[tuple[int, int, int]], bank_totals: dict[int, int]):
+        """
+        Сверяет рейтинги с БД: состав участников, балансы, кристаллы и суммы счетов.
+        Для пользователей, по которым были события во время пересчета, остаются значения из памяти.
+        """
+        touched = self.touched or set()
+        merged = {user_id: (balance, crystals, bank_totals.get(user_id, 0))
+                  for user_id, balance, crystals in users if user_id not in touched}
+        for user_id in touched:
+            if user_id in self.coins.wealth:
+                merged[user_id] = (self.coins.wealth[user_id], self.crystals.wealth[user_id],
+                                   self.bank_totals.get(user_id, 0))
+
+        self.bank_totals = {user_id: banks for user_id, (_, _, banks) in merged.items()}
+        self.wealth.load((user_id, balance + banks) for user_id, (balance, _, banks) in merged.items())
+        self.coins.load((user_id, balance) for user_id, (balance, _, _) in merged.items())
+        self.crystals.load((user_id, crystals) for user_id, (_, crystals, _) in merged.items())
+
+    def invalidate(self):
+        self.generation += 1
+        self.stale = True
+
+
+# Соединение открытой транзакции (Storage.transaction) в текущей задаче.
+transaction_connection: contextvars.ContextVar[aiomysql.Connection | None] = contextvars.ContextVar(
+    "transaction_connection", default=None)
+
+# Сбросы кэшей, сделанные в открытой транзакции. После COMMIT / ROLLBACK они выполняются повторно.
+transaction_invalidations: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "transaction_invalidations", default=None)
+
+# Изменения данных в памяти, сделанные в открытой транзакции, которые нужно сбросить при ROLLBACK.
+transaction_rollbacks: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "transaction_rollbacks", default=None)
+
+# Счетчик запросов в рамках обработки одного обновления Telegram (выставляется в middleware).
+update_queries: contextvars.ContextVar[list | None] = contextvars.ContextVar("update_queries", default=None)
+
+# Метод Storage, запустивший отдельные задачи (gather, single_flight): у задачи своего стека вызовов нет.
+query_site: contextvars.ContextVar[str] = contextvars.ContextVar("query_site", default="unknown")
+
+
+def _call_site() -> str:
+    """Имя ближайшего публичного метода Storage в стеке вызовов (или метода, запустившего задачу)."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        name = frame.f_code.co_name
+        if not name.startswith("_") and hasattr(Storage, name):
+            return name
+        frame = frame.f_back
+    return query_site.get()
+
+
+def _result_copy(result):
+    """Копия общего результата для одного ожидающего: список (кортеж) и словари в нем у каждого свои."""
+    if isinstance(result, (list, tuple)):
+        return type(result)(dict(item) if isinstance(item, dict) else item for item in result)
+    if isinstance(result, dict):
+        return dict(result)
+    return result
+
+
+def single_flight(method):
+    """
+    Одновременные вызовы метода Storage с одинаковыми аргументами ждут один общий запрос.
+    Каждый ожидающий получает свою копию результата (_result_copy).
+    Внутри транзакции метод вызывается как есть: ее соединение нельзя делить с другими задачами.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if transaction_connection.get() is not None:
+            return await method(self, *args, **kwargs)
+
+        key = (method.__name__,) + args + tuple(sorted(kwargs.items()))
+        task = self.in_flight.get(key)
+        if task is None:
+            # Задача копирует контекст при создании, поэтому место вызова выставляется до нее.
+            token = query_site.set(method.__name__ if not method.__name__.startswith("_") else _call_site())
+            try:
+                task = asyncio.ensure_future(method(self, *args, **kwargs))
+            finally:
+                query_site.reset(token)
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            self.query_stats.flights += 1
+        else:
+            self.query_stats.shared_flights += 1
+
+        # Отмена одного из ожидающих не должна отменять запрос для остальных.
+        return _result_copy(await asyncio.shield(task))
+    return wrapper
+
+
 class Storage:
     def __init__(self, loop):
         self.loop = loop
         self.pool = None
-        self.local = {}
-
-    def local_value(self, user_id: int, key: str, new_value=None, default_value=None):
-        uid = str(user_id)
+        self.pool_lock = asyncio.Lock()
+        self.pool_stats = PoolStats()
+        self.query_stats = QueryStats()
+        # Выполняющиеся запросы single_flight: {(имя метода, *аргументы): задача}.
+        self.in_flight: dict[tuple, asyncio.Future] = {}
+        self.user_cache = UserCache(config.USER_CACHE_MAX_SIZE, config.USER_CACHE_TTL)
+        self.group_cache = GroupCache(config.GROUP_CACHE_TTL)
+        self.group_cache_lock = asyncio.Lock()
+        self.bank_rates = BankRates()
+        self.bank_rates_lock = asyncio.Lock()
+        self.cooldowns = CooldownIndex()
+        self.last_seen = LastSeenIndex()
+        self.rankings = Rankings()
+        self.rankings_lock = asyncio.Lock()
+        self.rankings_task: asyncio.Task | None = None
+        # Подписчики на изменения балансов (BalanceEvent).
+        self.balance_listeners: list[typing.Callable[[BalanceEvent], None]] = [self.rankings.apply]
+        self.local = ExpiringStore(config.LOCAL_STORE_MAX_SIZE, config.LOCAL_STORE_TTL)
+        # Не записанные в БД изменения балансов: {user_id: [монетки, кристаллы]}.
+        self.balance_deltas: dict[int, list[int]] = {}
+        # Изменения балансов, которые сейчас записываются в БД: учитываются при чтении до завершения записи.
+        self.balance_flushing: dict[int, list[int]] = {}
+        self.balance_flush_lock = asyncio.Lock()
+        # Не записанная в БД активность в чате:
+        # {user_id: {"reward": вознаграждение, колонки ACTIVITY_KEYS: новые значения}}.
+        self.activity: dict[int, dict] = {}
+        # Активность, которая сейчас записывается в БД: учитывается при чтении, пока запись не завершится.
+        self.activity_flushing: dict[int, dict] = {}
+        self.activity_flush_lock = asyncio.Lock()
+
+    def local_value(self, user_id: int, key: str, new_value=None, default_value=None, ttl: int | None = None):
         if new_value is None:
-            return self.local.get(uid, {}).get(key, default_value)
+            return self.local.get(user_id, key, default_value)
         else:
-            if isinstance(new_value, (list, tuple, dict)):
-                new_value = copy.deepcopy(new_value)
-
-            if not self.local.get(uid):
-                self.local[uid] = {}
-
-            self.local[uid][key] = new_value
+            self.local.set(user_id, key, new_value, ttl)
 
     def reset_local_value(self, user_id: int, key: str):
-        uid = str(user_id)
-        if self.local.get(uid, {}).get(key):
-            self.local[uid].pop(key)
+        self.local.delete(user_id, key)
 
     def get_cooldown_last_time(self, user_id: int, key: str) -> int:
         last_time = self.local_value(user_id, key)
@@ -104,13 +953,14 @@ class Storage:
         last_time: int | float
         now = datetime.datetime.now()
 
+        # Значение нужно только до конца кд, поэтому и живет столько же.
         if not last_time:
-            self.local_value(user_id, key, now.timestamp())
+            self.local_value(user_id, key, now.timestamp(), ttl=required_cooldown)
             print(f"local_value: {self.local_value(user_id, key)}")
             return True
 
         if now.timestamp() - last_time >= required_cooldown:
-            self.local_value(user_id, key, now.timestamp())
+            self.local_value(user_id, key, now.timestamp(), ttl=required_cooldown)
             return True
         else:
             return False
@@ -118,163 +968,701 @@ class Storage:
     def common_cooldown(self, key: str, required_cooldown: int) -> bool:
         return self.cooldown(0, key, required_cooldown)
 
+    async def create_pool(self):
+        """Создание пула при запуске бота. Сразу открывается DB_POOL_MINSIZE соединений."""
+        async with self.pool_lock:
+            if self.pool is None:
+                self.pool = await aiomysql.create_pool(
+                    host=config.DB_HOST,
+                    port=config.DB_PORT,
+                    user=config.DB_USER,
+                    password=config.DB_PASSWORD,
+                    db=config.DB_DATABASE,
+                    loop=self.loop,
+                    minsize=config.DB_POOL_MINSIZE,
+                    maxsize=config.DB_POOL_MAXSIZE,
+                    pool_recycle=config.DB_POOL_RECYCLE,
+                    cursorclass=aiomysql.DictCursor,
+                    autocommit=True
+                )
+
+    async def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
     async def _update_pool(self):
         if self.pool is None:
-            self.pool = await aiomysql.create_pool(
-                host='127.0.0.1',
-                port=3306,
-                user=config.DB_USER,
-                password=config.DB_PASSWORD,
-                db=config.DB_DATABASE,
-                loop=self.loop,
-                cursorclass=aiomysql.DictCursor,
-                autocommit=True
-            )
-
-    async def _execute(self, query):
+            await self.create_pool()
+
+    @contextlib.asynccontextmanager
+    async def _acquire(self) -> typing.AsyncIterator[aiomysql.Connection]:
         # Создаем пул, если он не создан.
         await self._update_pool()
 
-        async with self.pool.acquire() as connection:
-            connection: aiomysql.Connection
+        started = time.monotonic()
+        try:
+            connection = await asyncio.wait_for(self.pool.acquire(), config.DB_POOL_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.pool_stats.timeouts += 1
+            raise
+        self.pool_stats.on_acquire(time.monotonic() - started)
+
+        try:
+            yield connection
+        finally:
+            self.pool_stats.on_release()
+            await self.pool.release(connection)
+
+    def get_pool_info(self) -> dict:
+        stats = self.pool_stats
+        return {
+            "size": self.pool.size if self.pool else 0,
+            "free": self.pool.freesize if self.pool else 0,
+            "minsize": config.DB_POOL_MINSIZE,
+            "maxsize": config.DB_POOL_MAXSIZE,
+            "in_use": stats.in_use,
+            "max_in_use": stats.max_in_use,
+            "acquired": stats.acquired,
+            "timeouts": stats.timeouts,
+            "wait_avg_ms": round(stats.wait_total / stats.acquired * 1000, 2) if stats.acquired else 0,
+            "wait_max_ms": round(stats.wait_max * 1000, 2)
+        }
+
+    async def _execute(self, query: str, params: tuple | None = None, lastrowid: bool = False, raw: bool = False):
+        """
+        :param lastrowid: вернуть ID вставленной записи вместо результата выборки.
+        :param raw: вернуть строки кортежами, без построения словаря на каждую строку.
+        """
+        cursor_classes = (aiomysql.Cursor,) if raw else ()
 
-            async with connection.cursor() as cursor:
-                cursor: aiomysql.cursors.DictCursor
+        # Внутри транзакции используем ее соединение.
+        connection = transaction_connection.get()
+        if connection is not None:
+            async with connection.cursor(*cursor_classes) as cursor:
+                return await self._cursor_execute(cursor, query, params, lastrowid)
 
-                if config.DEBUG_MODE:
-                    print(query.replace("    ", ""))
+        async with self._acquire() as connection:
+            async with connection.cursor(*cursor_classes) as cursor:
+                return await self._cursor_execute(cursor, query, params, lastrowid)
 
-                await cursor.execute(query)
-                return await cursor.fetchall()
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Все запросы внутри блока выполняются на одном соединении и фиксируются одним COMMIT.
+        При ошибке изменения откатываются. Вложенные блоки используют внешнюю транзакцию.
+        """
+        if transaction_connection.get() is not None:
+            yield
+            return
+
+        async with self._acquire() as connection:
+            await connection.begin()
+            token = transaction_connection.set(connection)
+            invalidations_token = transaction_invalidations.set([])
+            rollbacks = []
+            rollbacks_token = transaction_rollbacks.set(rollbacks)
+            committed = False
+            try:
+                yield
+                await connection.commit()
+                committed = True
+            except:
+                await connection.rollback()
+                raise
+            finally:
+                # Пока транзакция не была зафиксирована, в кэши могли попасть старые значения.
+                for invalidate in transaction_invalidations.get():
+                    invalidate()
+                transaction_rollbacks.reset(rollbacks_token)
+                transaction_invalidations.reset(invalidations_token)
+                transaction_connection.reset(token)
+
+                # Вне контекста транзакции: сбросы могут запускать задачи, которым нужно свое соединение.
+                if not committed:
+                    for rollback in rollbacks:
+                        rollback()
+
+    async def _cursor_execute(self, cursor: aiomysql.Cursor, query: str, params: tuple | None = None,
+                              lastrowid: bool = False):
+        site = _call_site()
+        started = time.monotonic()
+
+        # Значения передаются отдельно от текста запроса и экранируются драйвером.
+        await cursor.execute(query, params or None)
+        result = cursor.lastrowid if lastrowid else await cursor.fetchall()
+
+        self._record_query(site, query, params, time.monotonic() - started, cursor.rowcount)
+        return result
+
+    def _record_query(self, site: str, query: str, params: tuple | None, elapsed: float, rows: int):
+        self.query_stats.record_query(site, elapsed, rows)
+
+        counter = update_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+        logging.debug("SQL [%s] %.2f ms, rows: %s | %s %s", site, elapsed * 1000, rows, query, params)
+
+    async def _iterate(self, query: str, params: tuple | None = None, raw: bool = False,
+                       chunk_size: int = STREAM_CHUNK_SIZE) -> typing.AsyncIterator[dict | tuple]:
+        """
+        Потоковое чтение результата (SSCursor / SSDictCursor): строки забираются с сервера пачками
+        по chunk_size, вся выборка в памяти не собирается.
+        Соединение занято до конца итерации, поэтому внутри цикла не стоит надолго засыпать
+        (для долгой обработки есть постраничный iter_users).
+
+        :param raw: возвращать строки кортежами вместо словарей.
+        """
+        site = _call_site()
+        elapsed = 0.0
+        rows = 0
+
+        # Всегда берем отдельное соединение: пока результат не дочитан, выполнять на нем другие запросы нельзя.
+        async with self._acquire() as connection:
+            async with connection.cursor(aiomysql.SSCursor if raw else aiomysql.SSDictCursor) as cursor:
+                started = time.monotonic()
+                await cursor.execute(query, params or None)
+                elapsed += time.monotonic() - started
+
+                while True:
+                    started = time.monotonic()
+                    chunk = await cursor.fetchmany(chunk_size)
+                    elapsed += time.monotonic() - started
+                    if not chunk:
+                        break
+
+                    rows += len(chunk)
+                    for row in chunk:
+                        yield row
+
+        # В статистику попадает только время работы с БД, без обработки строк.
+        self._record_query(site, query, params, elapsed, rows)
+
+    # Тексты запросов собираются один раз для каждой формы вызова и далее берутся из кэша.
+    @staticmethod
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _exists_statement(table: str, where: str) -> str:
+        return f"SELECT 1 FROM {table} WHERE {where} LIMIT 1;"
 
     @staticmethod
-    def cnv(value) -> str:
-        if value is None:
-            return "NULL"
-        elif isinstance(value, datetime.datetime):
-            return f"'{value}'"
-        elif isinstance(value, bool):
-            return str(int(value))
-        return f"'{aiomysql.escape_string(str(value))}'"
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _update_statement(table: str, keys: tuple, where: str) -> str:
+        set_query = ", ".join([f"{k} = %s" for k in keys])
+        return f"UPDATE {table} SET {set_query} WHERE {where};"
 
     @staticmethod
-    def convert_update_string(d: dict) -> str:
-        return ", ".join([f"{k} = {Storage.cnv(v)}" for k, v in d.items()])
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _insert_statement(table: str, keys: tuple) -> str:
+        keys_query = ", ".join(keys)
+        values_query = ", ".join(["%s"] * len(keys))
+        return f"INSERT INTO {table} ({keys_query}) VALUES ({values_query});"
 
     @staticmethod
-    def convert_insert_string(values: typing.Iterable, escaping: bool) -> str:
-        return ", ".join([(Storage.cnv(x) if escaping else x) for x in values])
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _select_statement(table: str, keys: tuple | None, where: str | None, limited: bool,
+                          for_update: bool = False) -> str:
+        keys_query = ", ".join(keys) if keys else "*"
+        where_query = f" WHERE {where}" if where else ""
+        limit_query = " LIMIT %s" if limited else ""
+        lock_query = " FOR UPDATE" if for_update else ""
+        return f"SELECT {keys_query} FROM {table}{where_query}{limit_query}{lock_query};"
+
+    @staticmethod
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _delete_statement(table: str, where: str) -> str:
+        return f"DELETE FROM {table} WHERE {where} LIMIT %s;"
+
+    async def _exists(self, table: str, where: str, params: tuple = ()) -> bool:
+        q = self._exists_statement(table, where)
+        return bool(await self._execute(q, params))
+
+    async def _update(self, table: str, payload: dict, where: str, params: tuple = ()):
+        q = self._update_statement(table, tuple(payload.keys()), where)
+        await self._execute(q, tuple(payload.values()) + tuple(params))
 
-    async def _exists(self, table: str, where: str) -> bool:
-        q = f"""
-            SELECT 1 FROM {table}
-            WHERE {where};
+    async def _insert(self, table: str, payload: dict) -> int:
         """
-        return bool(await self._execute(q))
+        :return: ID созданной записи (AUTO_INCREMENT)
+        """
+        q = self._insert_statement(table, tuple(payload.keys()))
+        return await self._execute(q, tuple(payload.values()), lastrowid=True)
 
-    async def _update(self, table: str, payload: dict, where: str):
-        q = f"""
-            UPDATE {table}
-            SET {Storage.convert_update_string(payload)}
-            WHERE {where};
+    async def _select(self, table: str, keys: list | None = None, where: str | None = None, params: tuple = (),
+                      limit: int | None = None, for_update: bool = False) -> tuple[dict]:
         """
-        await self._execute(q)
-
-    async def _insert(self, table: str, payload: dict):
-        q = f"""
-            INSERT INTO {table}
-                ({Storage.convert_insert_string(payload.keys(), escaping=False)})
-            VALUES
-                ({Storage.convert_insert_string(payload.values(), escaping=True)});
+        :param for_update: заблокировать выбранные строки до конца транзакции.
         """
-        await self._execute(q)
+        q = self._select_statement(table, tuple(keys) if keys else None, where, bool(limit), for_update)
+        if limit:
+            params = tuple(params) + (limit,)
+        return await self._execute(q, params)
 
-    async def _select(self, table: str, keys: list | None = None, where: str | None = None, limit: int | None = None) -> tuple[dict]:
-        keys_query = ", ".join(keys) if keys else "*"
-        where_query = f"WHERE {where}" if where else ""
-        limit_queary = f"LIMIT {limit}" if limit else ""
+    async def _select_one(self, table: str, keys: list | None = None, where: str | None = None,
+                          params: tuple = (), for_update: bool = False) -> dict:
+        return (await self._select(table, keys, where, params, 1, for_update))[0]
 
-        q = f"""
-            SELECT {keys_query}
-            FROM {table} {where_query} {limit_queary};
+    @staticmethod
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _row_type(table: str, keys: tuple) -> type[Row]:
+        name = "".join(part.capitalize() for part in table.split("_")) + "Row"
+        return type(name, (collections.namedtuple(name, keys), Row), {"__slots__": ()})
+
+    async def _select_rows(self, table: str, keys: typing.Sequence[str], where: str | None = None,
+                           params: tuple = (), limit: int | None = None, for_update: bool = False) -> list[Row]:
+        """
+        Выборка только указанных колонок. Строки возвращаются неизменяемыми кортежами Row
+        (без словаря на каждую строку), доступ к колонкам по имени сохраняется.
         """
-        return await self._execute(q)
+        keys = tuple(keys)
+        q = self._select_statement(table, keys, where, bool(limit), for_update)
+        if limit:
+            params = tuple(params) + (limit,)
+        row_type = self._row_type(table, keys)
+        return [row_type._make(row) for row in await self._execute(q, params, raw=True)]
+
+    async def _select_one_row(self, table: str, keys: typing.Sequence[str], where: str | None = None,
+                              params: tuple = (), for_update: bool = False) -> Row:
+        return (await self._select_rows(table, keys, where, params, 1, for_update))[0]
+
+    async def _delete(self, table: str, where: str, params: tuple = (), limit: int = 1):
+        q = self._delete_statement(table, where)
+        await self._execute(q, tuple(params) + (limit,))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _upsert_statement(table: str, keys: tuple, update_keys: tuple, rows_count: int) -> str:
+        keys_query = ", ".join(keys)
+        row_query = "(" + ", ".join(["%s"] * len(keys)) + ")"
+        values_query = ", ".join([row_query] * rows_count)
+        update_query = ", ".join([f"{k} = VALUES({k})" for k in update_keys])
+        return f"INSERT INTO {table} ({keys_query}) VALUES {values_query} ON DUPLICATE KEY UPDATE {update_query};"
+
+    async def _upsert(self, table: str, payload: dict, update_keys: typing.Iterable[str]):
+        """Вставка записи или обновление полей update_keys, если запись с таким ключом уже есть."""
+        await self._upsert_many(table, [payload], update_keys)
+
+    async def _upsert_many(self, table: str, payloads: list[dict], update_keys: typing.Iterable[str]):
+        """То же, что и _upsert, но для нескольких записей одним запросом (ключи у записей должны совпадать)."""
+        if not payloads:
+            return
 
-    async def _select_one(self, table: str, keys: list | None = None, where: str | None = None) -> dict:
-        return (await self._select(table, keys, where, 1))[0]
+        keys = tuple(payloads[0].keys())
+        q = self._upsert_statement(table, keys, tuple(update_keys), len(payloads))
+        params = tuple(payload[k] for payload in payloads for k in keys)
+        await self._execute(q, params)
 
-    async def _delete(self, table: str, where: str, limit: int = 1):
-        q = f"""
-            DELETE FROM {table}
-            WHERE {where}
-            LIMIT {limit};
+    @staticmethod
+    def _buffering() -> bool:
+        # Внутри транзакции изменения пишутся сразу, чтобы попасть в общий COMMIT.
+        return config.BALANCE_BUFFER_ENABLED and transaction_connection.get() is None
+
+    def _buffer_balance_delta(self, user_id: int, coins: int = 0, crystals: int = 0):
+        delta = self.balance_deltas.setdefault(user_id, [0, 0])
+        delta[0] += int(coins)
+        delta[1] += int(crystals)
+
+        # Сбрасываем досрочно, если буфер переполнен.
+        if len(self.balance_deltas) >= config.BALANCE_BUFFER_MAX_ENTRIES and not self.balance_flush_lock.locked():
+            asyncio.create_task(self.flush_balance_deltas())
+
+    @staticmethod
+    def _buffering_activity() -> bool:
+        return config.ACTIVITY_BUFFER_ENABLED and transaction_connection.get() is None
+
+    def _pending_balance_delta(self, user_id: int) -> tuple[int, int]:
+        """Не записанные в БД изменения баланса пользователя: (монетки, кристаллы)."""
+        pending = self.balance_deltas.get(user_id, (0, 0))
+        flushing = self.balance_flushing.get(user_id, (0, 0))
+        return pending[0] + flushing[0], pending[1] + flushing[1]
+
+    def _pending_activity(self, user_id: int) -> dict | None:
+        """Не записанная в БД активность пользователя: из буфера и из записываемой сейчас пачки."""
+        pending = self.activity.get(user_id)
+        flushing = self.activity_flushing.get(user_id)
+        if pending and flushing:
+            return dict(pending, reward=pending["reward"] + flushing["reward"])
+        return pending or flushing
+
+    def _apply_balance_deltas(self, row: dict | Row | None) -> dict | Row | None:
+        """Добавляет к строке пользователя еще не записанные изменения балансов и активности."""
+        if row and (self.balance_deltas or self.balance_flushing or self.activity or self.activity_flushing):
+            user_id = row.get("user_id")
+            delta = self._pending_balance_delta(user_id)
+            activity = self._pending_activity(user_id)
+            if delta[0] or delta[1] or activity:
+                keys = row.keys()
+                coins = delta[0] + (activity["reward"] if activity else 0)
+                changes = {}
+                if "balance" in keys:
+                    changes["balance"] = row["balance"] + coins
+                if "crystals" in keys:
+                    changes["crystals"] = row["crystals"] + delta[1]
+                if activity:
+                    changes.update({k: activity[k] for k in ACTIVITY_KEYS if k in keys})
+
+                # Row неизменяемый, поэтому возвращается копия с новыми значениями.
+                if isinstance(row, Row):
+                    return row._replace(**changes)
+                row.update(changes)
+        return row
+
+    @staticmethod
+    def _invalidate(invalidate: typing.Callable[[], None]):
+        """Сбрасывает кэш сразу и, если открыта транзакция, повторно после ее завершения."""
+        invalidate()
+        invalidations = transaction_invalidations.get()
+        if invalidations is not None:
+            invalidations.append(invalidate)
+
+    def _users_changed(self, *user_ids: int):
+        """Сбрасывает записи кэша пользователей после изменения строк users."""
+        self._invalidate(functools.partial(self.user_cache.invalidate, *user_ids))
+
+    def _team_users_changed(self, team_id: int):
+        self._users_changed(*self.user_cache.team_members(team_id))
+
+    def _groups_changed(self):
+        """Сбрасывает кэш групп после изменения teams или состава групп."""
+        self._invalidate(self.group_cache.invalidate)
+
+    async def _load_groups(self) -> GroupCache:
+        if self.group_cache.fresh():
+            self.group_cache.hits += 1
+            return self.group_cache
+
+        async with self.group_cache_lock:
+            if not self.group_cache.fresh():
+                generation = self.group_cache.generation
+                teams, memberships = await self._gather(
+                    self._select(Tables.teams),
+                    self._select_rows(Tables.users, ("user_id", "team_id"), "team_id IS NOT NULL"))
+                self.group_cache.load(teams, memberships, generation)
+        return self.group_cache
+
+    @staticmethod
+    async def _gather(*aws: typing.Awaitable) -> list:
+        """
+        asyncio.gather для запросов. Внутри транзакции запросы выполняются по очереди:
+        задачи наследуют ее соединение, а одно соединение не может выполнять запросы одновременно.
+        Запросы в задачах учитываются в статистике за вызвавшим методом.
         """
-        await self._execute(q)
+        if transaction_connection.get() is not None:
+            return [await aw for aw in aws]
 
-    async def _insert_or_update(self, table: str, insert_payload: dict,
-                                update_payload: dict, where: str) -> bool:
+        token = query_site.set(_call_site())
+        try:
+            return list(await asyncio.gather(*aws))
+        finally:
+            query_site.reset(token)
+
+    def _bank_rates_changed(self, update: typing.Callable[[], None]):
+        """Применяет изменение к ставкам сразу. Если транзакция будет отменена, ставки перечитываются из БД."""
+        update()
+        rollbacks = transaction_rollbacks.get()
+        if rollbacks is not None:
+            rollbacks.append(self.bank_rates.invalidate)
+
+    def _balance_changed(self, event: BalanceEvent):
+        """Уведомляет подписчиков об изменении балансов. Если транзакция будет отменена, рейтинги перечитываются."""
+        for listener in self.balance_listeners:
+            listener(event)
+        rollbacks = transaction_rollbacks.get()
+        if rollbacks is not None and self._reload_rankings not in rollbacks:
+            rollbacks.append(self._reload_rankings)
+
+    def _reload_rankings(self):
+        self.rankings.invalidate()
+        self._start_rankings_load()
+
+    def _start_rankings_load(self):
+        """Запускает загрузку рейтингов в фоне, если она еще не идет."""
+        if self.rankings_task is None or self.rankings_task.done():
+            self.rankings_task = asyncio.create_task(self.load_rankings())
+
+    async def load_rankings(self):
+        """Загружает рейтинги из БД (при запуске и после отмененных транзакций)."""
+        async with self.rankings_lock:
+            if self.rankings.fresh:
+                return
+
+            # Если во время чтения пришли события, данные могли их не учесть - читаем еще раз.
+            for _ in range(3):
+                generation = self.rankings.generation
+                await self.flush_balance_deltas()
+                users, banks = await self._gather(
+                    self._select_rows(Tables.users, ("user_id", "balance", "crystals"), "banned = 0 AND agreed = 1"),
+                    self.get_top_banks())
+                if generation == self.rankings.generation:
+                    break
+            self.rankings.load(users, utils.sum_banks_by_owner(banks))
+
+    def _rankings_ready(self) -> bool:
         """
-        :return: True - Inserted, False - Updated
+        Можно ли отвечать из рейтингов в памяти. Пока они перечитываются из БД, в режиме
+        RANKINGS_STALE_WHILE_REVALIDATE отдаются прежние значения, иначе ответ строится по БД.
         """
-        # Проверяем на наличие записи в таблице.
-        if await self._exists(table, where):
-            if update_payload:
-                # Запись существует, обновляем.
-                await self._update(table, update_payload, where)
-            return False
-        else:
-            if insert_payload:
-                # Запись отсутствует, создаем.
-                await self._insert(table, insert_payload)
+        if self.rankings.fresh:
             return True
+        if self.rankings.loaded and config.RANKINGS_STALE_WHILE_REVALIDATE:
+            self._start_rankings_load()
+            return True
+        return False
+
+    async def _load_rankings(self) -> Rankings:
+        """Рейтинги для ответа (см. _rankings_ready). Если отдавать их нельзя, ждем загрузки."""
+        if not self._rankings_ready():
+            await self.load_rankings()
+        assert self.rankings.loaded, "Рейтинг временно недоступен"
+        return self.rankings
+
+    async def _load_bank_rates(self) -> BankRates:
+        if self.bank_rates.loaded:
+            return self.bank_rates
+
+        async with self.bank_rates_lock:
+            if not self.bank_rates.loaded:
+                generation = self.bank_rates.generation
+                users, teams = await self._gather(
+                    self._select_rows(Tables.users, ("user_id", "team_id", "extra_percent")),
+                    self._select_rows(Tables.teams, ("team_id", "level")))
+                self.bank_rates.load(users, teams, generation)
+        return self.bank_rates
+
+    async def get_bank_rate(self, user_id: int) -> int:
+        """Ставка по банковским счетам пользователя (% в день)."""
+        return (await self._load_bank_rates()).rate(user_id)
+
+    async def _get_profile_row(self, user_id: int) -> Row:
+        """Профиль пользователя из кэша или БД (IndexError, если пользователя нет)."""
+        row = self.user_cache.get(user_id)
+        if row is None:
+            generation = self.user_cache.generation
+            row = await self._select_one_row(Tables.users, USER_PROFILE_KEYS, "user_id = %s", (user_id,))
+            self.user_cache.put(row, generation)
+        return row
+
+    @staticmethod
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _balance_deltas_statement(count: int) -> str:
+        cases = " ".join(["WHEN %s THEN %s"] * count)
+        ids = ", ".join(["%s"] * count)
+        return (f"UPDATE users SET balance = balance + CASE user_id {cases} ELSE 0 END, "
+                f"crystals = crystals + CASE user_id {cases} ELSE 0 END "
+                f"WHERE user_id IN ({ids});")
+
+    def _chat_activity(self, user, team_level: int) -> tuple[int, datetime.datetime, datetime.datetime]:
+        """Вознаграждение за общение и новые отметки времени: (вознаграждение, reward_updated, updated)."""
+        reward = 0
+        reward_updated = user.reward_updated
+        updated = user.updated
+        now_time = datetime.datetime.now()
+        if user.reward_updated and now_time.timestamp() - user.reward_updated.timestamp() >= config.COOLDOWN_CHAT_REWARD:
+            if not config.DEBUG_MODE:
+                reward = utils.calc_reward(team_level)
+            reward_updated = now_time
+
+        # Обновляем только если пользователь не в муте.
+        if not user.is_muted():
+            updated = now_time
+
+        return reward, reward_updated, updated
+
+    def _buffer_activity(self, user, row: dict | Row, reward: int,
+                         reward_updated: datetime.datetime, updated: datetime.datetime):
+        """:param row: строка пользователя (с учетом буфера), с которой сравниваются новые значения."""
+        self.last_seen.touch(user.user_id, updated)
+
+        # Если изменилось только время активности, в БД оно обновляется не чаще LAST_SEEN_FLUSH_SECONDS.
+        unchanged = not reward and reward_updated == row["reward_updated"] and (
+            (user.username, user.first_name, user.last_name) == (row["username"], row["first_name"], row["last_name"]))
+        if unchanged and (updated == row["updated"] or (
+                updated and row["updated"] and
+                (updated - row["updated"]).total_seconds() < config.LAST_SEEN_FLUSH_SECONDS)):
+            return
+
+        pending = self.activity.get(user.user_id)
+        self.activity[user.user_id] = {
+            "reward": reward + (pending["reward"] if pending else 0),
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "reward_updated": reward_updated,
+            "updated": updated
+        }
+        if reward:
+            self._balance_changed(BalanceEvent(user.user_id, coins=reward))
+
+        # Сбрасываем досрочно, если буфер переполнен.
+        if len(self.activity) >= config.ACTIVITY_BUFFER_MAX_ENTRIES and not self.activity_flush_lock.locked():
+            asyncio.create_task(self.flush_activity())
+
+    @staticmethod
+    @functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _activity_statement(count: int) -> str:
+        cases = " ".join(["WHEN %s THEN %s"] * count)
+        ids = ", ".join(["%s"] * count)
+        columns = ", ".join(f"{k} = CASE user_id {cases} END" for k in ACTIVITY_KEYS)
+        return (f"UPDATE users SET balance = balance + CASE user_id {cases} ELSE 0 END, {columns} "
+                f"WHERE user_id IN ({ids});")
+
+    async def flush_activity(self):
+        """Записывает накопленные вознаграждения за общение и отметки активности одним запросом."""
+        async with self.activity_flush_lock:
+            if not self.activity:
+                return
+
+            activity, self.activity = self.activity, {}
+            params = []
+            for k in ("reward",) + ACTIVITY_KEYS:
+                for user_id, changes in activity.items():
+                    params += [user_id, changes[k]]
+            params += list(activity.keys())
+
+            # До завершения записи пачка учитывается при чтении, в кэш она переносится только после нее.
+            self.activity_flushing = activity
+            entries = self.user_cache.entries(activity.keys())
+            try:
+                await self._execute(self._activity_statement(len(activity)), tuple(params))
+                self.user_cache.add_activity(activity, entries)
+            except:
+                self._users_changed(*activity.keys())
+                # Возвращаем активность в буфер (более новая уже могла накопиться поверх).
+                for user_id, changes in activity.items():
+                    pending = self.activity.get(user_id)
+                    if pending:
+                        pending["reward"] += changes["reward"]
+                    else:
+                        self.activity[user_id] = changes
+                raise
+            finally:
+                self.activity_flushing = {}
+
+    async def process_activity(self):
+        """Фоновый сброс буфера активности."""
+        while True:
+            await asyncio.sleep(config.ACTIVITY_BUFFER_FLUSH_SECONDS)
+            try:
+                await self.flush_activity()
+            except Exception as e:
+                print(f"ACTIVITY FLUSH E: {e}")
+
+    async def flush_balance_deltas(self):
+        """Записывает накопленные изменения балансов (и активности) одним запросом."""
+        await self.flush_activity()
+        async with self.balance_flush_lock:
+            if not self.balance_deltas:
+                return
+
+            deltas, self.balance_deltas = self.balance_deltas, {}
+            params = []
+            for user_id, (coins, _) in deltas.items():
+                params += [user_id, coins]
+            for user_id, (_, crystals) in deltas.items():
+                params += [user_id, crystals]
+            params += list(deltas.keys())
+
+            # До завершения записи изменения учитываются при чтении, в кэш они переносятся только после нее.
+            self.balance_flushing = deltas
+            entries = self.user_cache.entries(deltas.keys())
+            try:
+                await self._execute(self._balance_deltas_statement(len(deltas)), tuple(params))
+                self.user_cache.add_balances(deltas, entries)
+            except:
+                self._users_changed(*deltas.keys())
+                # Возвращаем изменения в буфер, чтобы не потерять их.
+                for user_id, (coins, crystals) in deltas.items():
+                    delta = self.balance_deltas.setdefault(user_id, [0, 0])
+                    delta[0] += coins
+                    delta[1] += crystals
+                raise
+            finally:
+                self.balance_flushing = {}
+
+    async def process_balance_deltas(self):
+        """Фоновый сброс буфера балансов."""
+        while True:
+            await asyncio.sleep(config.BALANCE_BUFFER_FLUSH_MS / 1000)
+            try:
+                await self.flush_balance_deltas()
+            except Exception as e:
+                print(f"BALANCE FLUSH E: {e}")
 
     async def increase_user_balance(self, user_id: int, increase_by: int):
-        q = f"""
+        if self._buffering():
+            self._buffer_balance_delta(user_id, coins=increase_by)
+            self._balance_changed(BalanceEvent(user_id, coins=increase_by))
+            return
+
+        q = """
             UPDATE users
-            SET balance = balance + {increase_by}
-            WHERE user_id = {user_id};
+            SET balance = balance + %s
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (increase_by, user_id))
+        self._users_changed(user_id)
+        self._balance_changed(BalanceEvent(user_id, coins=increase_by))
 
     async def load_user_balance_from_db(self, user):
-        condition = f"user_id = {user.user_id}"
-        info = await self._select_one(Tables.users, where=condition)
+        info = self._apply_balance_deltas(await self._select_one(Tables.users, where="user_id = %s",
+                                                                 params=(user.user_id,)))
 
         user.balance = info["balance"]
         user.crystals = info["crystals"]
 
     async def decrease_user_balance(self, user_id: int, decrease_by: int):
         """Уменьшение баланса"""
-        q = f"""
+        if self._buffering():
+            self._buffer_balance_delta(user_id, coins=-decrease_by)
+            self._balance_changed(BalanceEvent(user_id, coins=-decrease_by))
+            return
+
+        q = """
             UPDATE users
-            SET balance = balance - {decrease_by}
-            WHERE user_id = {user_id};
+            SET balance = balance - %s
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (decrease_by, user_id))
+        self._users_changed(user_id)
+        self._balance_changed(BalanceEvent(user_id, coins=-decrease_by))
 
     async def add_user_crystals(self, user_id: int, crystals: int):
         """Увеличение баланса"""
-        q = f"""
+        if self._buffering():
+            self._buffer_balance_delta(user_id, crystals=crystals)
+            self._balance_changed(BalanceEvent(user_id, crystals=crystals))
+            return
+
+        q = """
             UPDATE users
-            SET crystals = crystals + {crystals}
-            WHERE user_id = {user_id};
+            SET crystals = crystals + %s
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (crystals, user_id))
+        self._users_changed(user_id)
+        self._balance_changed(BalanceEvent(user_id, crystals=crystals))
 
     async def remove_user_crystals(self, user_id: int, crystals: int):
-        q = f"""
+        if self._buffering():
+            self._buffer_balance_delta(user_id, crystals=-crystals)
+            self._balance_changed(BalanceEvent(user_id, crystals=-crystals))
+            return
+
+        q = """
             UPDATE users
-            SET crystals = crystals - {crystals}
-            WHERE user_id = {user_id};
+            SET crystals = crystals - %s
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (crystals, user_id))
+        self._users_changed(user_id)
+        self._balance_changed(BalanceEvent(user_id, crystals=-crystals))
 
     async def user_exists(self, user_id: int) -> bool:
-        return await self._exists(Tables.users, f"user_id = {user_id}")
+        return await self._exists(Tables.users, "user_id = %s", (user_id,))
 
     async def load_user_from_db(self, user):
-        where = f"user_id = {user.user_id}"
-        user_info = await self._select_one(Tables.users, where=where)
+        user_info = self._apply_balance_deltas(await self._get_profile_row(user.user_id))
 
         if not (user.username or user.first_name or user.last_name):
             user.username = user_info["username"]
@@ -297,12 +1685,18 @@ class Storage:
         user.created = user_info["created"]
 
     async def update_user(self, user):
-        condition = f"user_id = {user.user_id}"
+        condition = "user_id = %s"
+        params = (user.user_id,)
         # Проверяем на существование учетную запись пользователя.
-        if await self._exists(Tables.users, condition):
+        if await self._exists(Tables.users, condition, params):
             user.first = False
             # Загружаем информацию из БД.
-            user_info = await self._select_one(Tables.users, where=condition)
+            row = await self._select_one(Tables.users, where=condition, params=params)
+            group_level = await self.get_group_level(row["team_id"])
+
+            # После последнего await: чтение буфера и запись в него не перемежаются с другими сообщениями,
+            # поэтому вознаграждение, отложенное за время ожидания, повторно не начислится.
+            user_info = self._apply_balance_deltas(row)
 
             user.balance = user_info["balance"]
             user.crystals = user_info["crystals"]
@@ -321,31 +1715,26 @@ class Storage:
             user.updated = user_info["updated"]
             user.created = user_info["created"]
 
+            # Проверяем вознаграждение за общение.
+            reward, reward_updated, updated = self._chat_activity(user, group_level)
+            if self._buffering_activity():
+                self._buffer_activity(user, user_info, reward, reward_updated, updated)
+                return
+            self.last_seen.touch(user.user_id, updated)
+
             # Обновляем значения пользователя, которые могут измениться.
             payload = {
                 "username": user.username,
                 "first_name": user.first_name,
-                "last_name": user.last_name
+                "last_name": user.last_name,
+                "reward_updated": reward_updated,
+                "updated": updated
             }
+            if reward:
+                await self.increase_user_balance(user.user_id, reward)
 
-            # Проверяем вознаграждение за общение.
-            now_time = datetime.datetime.now()
-            if user.reward_updated and now_time.timestamp() - user.reward_updated.timestamp() >= config.COOLDOWN_CHAT_REWARD:
-                if not config.DEBUG_MODE:
-                    # Получаем уровень группы.
-                    group_level = await self.get_group_level(user.team_id)
-                    # Вычисляем вознаграждение.
-                    reward = utils.calc_reward(group_level)
-                    # Обновляем значение баланса в БД.
-                    await self.increase_user_balance(user.user_id, reward)
-                # Прописываем новое время последнего вознаграждения.
-                payload["reward_updated"] = now_time
-
-            # Обновляем только если пользователь не в муте.
-            if not user.is_muted():
-                payload["updated"] = now_time
-
-            await self._update(Tables.users, payload, condition)
+            await self._update(Tables.users, payload, condition, params)
+            self._users_changed(user.user_id)
 
         else:
             # Первый вход в бота.
@@ -358,64 +1747,207 @@ class Storage:
                 "last_name": user.last_name
             }
             await self._insert(Tables.users, payload)
+            self.last_seen.touch(user.user_id, datetime.datetime.now())
+            self._bank_rates_changed(functools.partial(self.bank_rates.add_extra, user.user_id, 0))
 
-    async def update_temp_storage(self, key_name: str, string_value: str | int | None):
-        if not (string_value is None):
-            string_value = str(string_value)
+    async def touch_user(self, user, chat_id: int, require_agreed: bool = True, subscribed: bool = True) -> bool:
+        """
+        Загрузка пользователя и обновление его активности за одну транзакцию.
+        Обновление применяется только если пользователь прошел бы проверку доступности.
+        :param subscribed: пользователь состоит в чате (проверяется только для лс).
+        :return: True - пользователь существует, False - записи нет
+        """
+        if self._buffering_activity():
+            return await self._touch_user_buffered(user, chat_id, require_agreed, subscribed)
+
+        # Блокируется только строка пользователя: уровень группы берется из кэша групп.
+        q_select = "SELECT * FROM users WHERE user_id = %s FOR UPDATE;"
+        async with self.transaction():
+            rows = await self._execute(q_select, (user.user_id,))
+            if not rows:
+                user.first = True
+                return False
+            team_level = await self.get_group_level(rows[0]["team_id"])
+
+            # Строка для кэша - в том виде, в каком она будет в БД после обновления.
+            profile_row = self._row_type(Tables.users, USER_PROFILE_KEYS)._make(
+                rows[0][k] for k in USER_PROFILE_KEYS)
+            user_info = self._apply_balance_deltas(rows[0])
 
-        payload = {
-            "key_name": key_name,
-            "string_value": string_value
-        }
+            user.first = False
+            names = (user.username, user.first_name, user.last_name)
+            user.load_from_dict(user_info)
+            if any(names):
+                user.username, user.first_name, user.last_name = names
+            user.team_level = team_level
+
+            if self._can_touch(user, chat_id, require_agreed, subscribed):
+                # Проверяем вознаграждение за общение.
+                reward, reward_updated, updated = self._chat_activity(user, user.team_level)
+                self.last_seen.touch(user.user_id, updated)
+
+                q_update = """
+                    UPDATE users
+                    SET username = %s, first_name = %s, last_name = %s,
+                        balance = balance + %s, reward_updated = %s, updated = %s
+                    WHERE user_id = %s;
+                """
+                params = (user.username, user.first_name, user.last_name,
+                          reward, reward_updated, updated, user.user_id)
+                await self._execute(q_update, params)
+                self._users_changed(user.user_id)
+                self._balance_changed(BalanceEvent(user.user_id, coins=reward))
+                profile_row = profile_row._replace(username=user.username, first_name=user.first_name,
+                                                   last_name=user.last_name, balance=profile_row.balance + reward,
+                                                   reward_updated=reward_updated, updated=updated)
+
+        # Строка была заблокирована до COMMIT, поэтому она актуальна и кладется в кэш без проверки поколения.
+        self.user_cache.put(profile_row, self.user_cache.generation)
+        return True
+
+    @staticmethod
+    def _can_touch(user, chat_id: int, require_agreed: bool, subscribed: bool) -> bool:
+        # Те же условия, что и в проверке доступности (tg.check_availability).
+        if user.user_id in config.IGNORED_IDS or chat_id not in (config.CHAT_ID, user.user_id):
+            return False
+        return user.admin() or (
+            not user.banned and (user.agreed or not require_agreed) and not user.is_muted()
+            # В лс пишут только участники чата.
+            and (chat_id == config.CHAT_ID or subscribed))
+
+    async def _touch_user_buffered(self, user, chat_id: int, require_agreed: bool, subscribed: bool) -> bool:
+        """
+        touch_user без транзакции: профиль берется из кэша, а активность копится в буфере
+        и записывается в БД пачкой (flush_activity).
+        """
+        try:
+            row = await self._get_profile_row(user.user_id)
+        except IndexError:
+            user.first = True
+            return False
+        team_level = await self.get_group_level(row.team_id)
+
+        # После последнего await: чтение буфера и запись в него не перемежаются с другими сообщениями.
+        user_info = self._apply_balance_deltas(row)
+        user.first = False
+        names = (user.username, user.first_name, user.last_name)
+        user.load_from_dict(user_info)
+        if any(names):
+            user.username, user.first_name, user.last_name = names
+        user.team_level = team_level
 
-        await self._insert_or_update(Tables.temp_storage, payload, payload, f"key_name = {self.cnv(key_name)}")
+        if self._can_touch(user, chat_id, require_agreed, subscribed):
+            self._buffer_activity(user, user_info, *self._chat_activity(user, team_level))
+        return True
+
+    async def update_temp_storage(self, key_name: str, string_value: str | int | None):
+        await self.update_temp_storage_many({key_name: string_value})
+
+    async def update_temp_storage_many(self, values: dict[str, str | int | None]):
+        payloads = [
+            {
+                "key_name": key_name,
+                "string_value": None if string_value is None else str(string_value)
+            }
+            for key_name, string_value in values.items()
+        ]
+        await self._upsert_many(Tables.temp_storage, payloads, ["string_value"])
 
     async def get_temp_storage(self, key_name: str) -> str | None:
         try:
-            return (await self._select_one(Tables.temp_storage, ["string_value"], f"key_name = {self.cnv(key_name)}"))["string_value"]
+            return (await self._select_one(Tables.temp_storage, ["string_value"], "key_name = %s", (key_name,)))["string_value"]
         except:
             return
 
-    async def get_user_by_id(self, user_id: int) -> dict:
-        cond = f"user_id = {user_id}"
-        return await self._select_one(Tables.users, where=cond)
+    async def get_user_by_id(self, user_id: int) -> Row:
+        return self._apply_balance_deltas(await self._get_profile_row(user_id))
 
-    async def search_user(self, search_text: str) -> dict:
+    async def search_user(self, search_text: str) -> Row:
         mandatory_condition = " AND banned = 0 AND agreed = 1"
         if search_text.isdigit():
             # Проверяем как ID пользователя.
-            wh = f"user_id = {int(search_text)}" + mandatory_condition
+            wh = "user_id = %s" + mandatory_condition
+            params = (int(search_text),)
+            row = self.user_cache.get(int(search_text))
         else:
             # Проверяем как юзернейм пользователя.
             ready_search_text = search_text.lower().replace('@', '')
-            wh = (f"(username = {self.cnv(ready_search_text)} OR msg_code = {self.cnv(ready_search_text)})"
-                  + mandatory_condition)
-        return await self._select_one(Tables.users, where=wh)
+            wh = "(username = %s OR msg_code = %s)" + mandatory_condition
+            params = (ready_search_text, ready_search_text)
+            row = self.user_cache.get_by_name(ready_search_text)
+
+        if row is None or row.banned or not row.agreed:
+            generation = self.user_cache.generation
+            row = await self._select_one_row(Tables.users, USER_PROFILE_KEYS, wh, params)
+            self.user_cache.put(row, generation)
+        return self._apply_balance_deltas(row)
+
+    async def load_cooldowns(self):
+        """Загружает из БД недавние обнимашки, жалобы, опросы и голоса для проверок кд."""
+        now = datetime.datetime.now()
+        polls_since = now - CooldownIndex.polls_window()
+        q_votes = """
+            SELECT v.poll_id, v.stage, v.user_id FROM votes v
+            JOIN polls p ON p.poll_id = v.poll_id
+            WHERE p.created >= %s;
+        """
+        hugs, reports, polls, votes = await self._gather(
+            self._select_rows(Tables.hugs, ("from_id", "to_id", "created"), "created >= %s",
+                              (now - CooldownIndex.hugs_window(),)),
+            self._select_rows(Tables.reports, ("from_id", "to_id", "created"), "created >= %s",
+                              (now - CooldownIndex.reports_window(),)),
+            self._select_rows(Tables.polls, ("poll_id", "to_id", "created", "stage"), "created >= %s",
+                              (polls_since,)),
+            self._execute(q_votes, (polls_since,), raw=True)
+        )
+
+        cooldowns = CooldownIndex()
+        for hug in hugs:
+            cooldowns.add_hug(hug.from_id, hug.to_id, hug.created)
+        for report in reports:
+            cooldowns.add_report(report.from_id, report.to_id, report.created)
+        for poll in polls:
+            cooldowns.add_poll(poll.poll_id, poll.to_id, poll.created, poll.stage)
+        cooldowns.votes = set(votes)
+        cooldowns.loaded = True
+
+        self.cooldowns = cooldowns
+
+    async def load_last_seen(self):
+        """Загружает время последней активности незаблокированных пользователей."""
+        rows = await self._select_rows(Tables.users, ("user_id", "updated"), "banned = 0")
+        self.last_seen.load(rows)
 
     async def last_hug_user(self, from_id: int, to_id: int) -> datetime.datetime | None:
+        if self.cooldowns.loaded:
+            return self.cooldowns.hug_pairs.get((from_id, to_id))
+
         try:
-            q = f"""
+            q = """
                 SELECT created FROM hugs
-                WHERE from_id = {from_id} AND to_id = {to_id}
+                WHERE from_id = %s AND to_id = %s
                 ORDER BY created DESC LIMIT 1;
             """
-            return (await self._execute(q))[0]["created"]
+            return (await self._execute(q, (from_id, to_id)))[0]["created"]
         except:
             return
 
     async def last_hug(self, from_id: int) -> datetime.datetime | None:
+        if self.cooldowns.loaded:
+            return self.cooldowns.hugs.get(from_id)
+
         try:
-            q = f"""
+            q = """
                 SELECT created FROM hugs
-                WHERE from_id = {from_id}
+                WHERE from_id = %s
                 ORDER BY created DESC LIMIT 1;
             """
-            return (await self._execute(q))[0]["created"]
+            return (await self._execute(q, (from_id,)))[0]["created"]
         except:
             return
 
     async def hug_exists(self, from_id: int, to_id: int) -> bool:
-        return await self._exists(Tables.hugs, f"from_id = {from_id} AND to_id = {to_id}")
+        return await self._exists(Tables.hugs, "from_id = %s AND to_id = %s", (from_id, to_id))
 
     async def add_hug(self, from_id: int, from_balance: int, to_id: int):
         payload = {
@@ -423,76 +1955,36 @@ class Storage:
             "to_id": to_id
         }
         await self._insert(Tables.hugs, payload)
+        self.cooldowns.add_hug(from_id, to_id, datetime.datetime.now())
         await self.increase_user_balance(to_id, utils.calc_hug_reward(from_balance))
 
     async def get_users_percent_dict(self) -> dict:
-        users_task = asyncio.create_task(self._select(Tables.users))
-        group_task = asyncio.create_task(self._select(Tables.teams))
-
-        users = await users_task
-        groups_list: tuple[dict] = await group_task
-
-        groups = {}
-        for group in groups_list:
-            group: dict
-            groups[group['team_id']] = group['level']
-
-        percentage = {}
-        for user in users:
-            extra_group_percent = groups.get(user['team_id'], 0)
-            percentage[user['user_id']] = int(user['extra_percent'] + config.BET_BANK_DAILY_DEFAULT + extra_group_percent)
-
-        return percentage
-
-    async def get_top_groups(self) -> list:
-        cond = f"team_id AND banned = 0 AND agreed = 1"
-
-        group_members_task = asyncio.create_task(self._select(Tables.users, where=cond))
-        banks_task = asyncio.create_task(self.get_top_banks())
-        groups_db_task = asyncio.create_task(self.get_groups())
-
-        group_members = list(await group_members_task)
-        banks = await banks_task
-        groups_db = await groups_db_task
-
-        # keys: members: list[int], balance: int
-        groups = {}
+        return dict((await self._load_bank_rates()).rates)
 
-        for member in group_members:
-            user_id: int = member['user_id']
-            group_id: int = member['team_id']
-            balance: int = member['balance']
-            crystals: int = member['crystals']
+    async def get_top_groups(self, banks: list | None = None) -> list:
+        if self._rankings_ready():
+            return await self._get_top_groups_ranked()
 
-            if groups.get(group_id) is None:
-                groups[group_id] = {
-                    "members": [],
-                    "balance": 0,
-                    "crystals": 0
-                }
+        # Выборки по таблице должны учитывать отложенные изменения балансов.
+        await self.flush_balance_deltas()
 
-            groups[group_id]["members"].append(user_id)
-            groups[group_id]["balance"] += balance
-            groups[group_id]["crystals"] += crystals
+        cond = "team_id AND banned = 0 AND agreed = 1"
 
-        for bank in banks:
-            owner_id: int = bank["user_id"]
-            now_balance: int = bank['unbankSum']
+        group_members, banks, groups_db = await self._gather(
+            self._select_rows(Tables.users, ("user_id", "team_id", "balance", "crystals"), cond),
+            self._get_banks(banks),
+            self.get_groups()
+        )
 
-            for group_id in groups.keys():
-                if owner_id in groups[group_id]['members']:
-                    groups[group_id]['balance'] += now_balance
-                    break
-
-        for group_info in groups_db:
-            if groups.get(group_info['team_id']):
-                groups[group_info['team_id']]['caption'] = group_info['caption']
+        # Счета прибавляются к участникам по словарю владелец -> сумма счетов.
+        groups = utils.sum_group_balances(group_members, banks)
+        captions = {group_info['team_id']: group_info['caption'] for group_info in groups_db}
 
         groups = [
             {
                 "group_id": gid,
-                "caption": groups[gid]['caption'],
-                "members": len(groups[gid]['members']),
+                "caption": captions[gid],
+                "members": groups[gid]['members'],
                 "balance": int(groups[gid]['balance']),
                 "crystals": int(groups[gid]['crystals'])
             }
@@ -502,39 +1994,104 @@ class Storage:
 
         return groups
 
+    async def _get_top_groups_ranked(self) -> list:
+        """get_top_groups по рейтингам в памяти и индексу участников групп."""
+        group_cache = await self._load_groups()
+        wealth, crystals = self.rankings.wealth.wealth, self.rankings.crystals.wealth
+        captions = {group_info['team_id']: group_info['caption'] for group_info in await self.get_groups()}
+
+        groups = []
+        for group_id, member_ids in group_cache.members.items():
+            member_ids = [user_id for user_id in member_ids if user_id in wealth]
+            if not member_ids or group_id not in captions:
+                continue
+            groups.append({
+                "group_id": group_id,
+                "caption": captions[group_id],
+                "members": len(member_ids),
+                "balance": int(sum(wealth[user_id] for user_id in member_ids)),
+                "crystals": int(sum(crystals.get(user_id, 0) for user_id in member_ids))
+            })
+        groups.sort(key=lambda x: x["balance"], reverse=True)
+
+        return groups
+
+    async def get_rated_users_count(self) -> int:
+        """Количество участников рейтинга."""
+        return len((await self._load_rankings()).wealth)
+
+    async def _get_banks(self, banks: list | None) -> list:
+        return banks if banks is not None else await self.get_top_banks()
+
+    @single_flight
     async def get_top_banks(self) -> list:
         cond = "status = 1"
         banks = list(await self._select(Tables.banks, where=cond))
-        users_percent_dict = await self.get_users_percent_dict()
+        bank_rates = await self._load_bank_rates()
 
-        for bank in banks:
-            owner_id = bank["user_id"]
-            user_percent = users_percent_dict[owner_id]
-            bank["unbankSum"] = utils.calc_bank_balance(bank["balance"], user_percent, bank["created"])
+        percents = [bank_rates.rate(bank["user_id"]) for bank in banks]
+        values = utils.calc_bank_balances([bank["balance"] for bank in banks], percents,
+                                          [bank["created"] for bank in banks])
+        for bank, user_percent, value in zip(banks, percents, values):
+            bank["unbankSum"] = value
             bank["ownerPercent"] = user_percent
 
         banks.sort(key=lambda x: x["unbankSum"], reverse=True)
 
         return banks
 
+    @single_flight
+    async def get_top_n_banks(self, limit: int) -> list:
+        """
+        Первые limit счетов по текущей сумме. Сумма (как utils.calc_bank_balance) и ставка владельца
+        (как BankRates) считаются в БД, поэтому из нее приходят только limit строк.
+        Счета без записи владельца считаются по базовой ставке, как в BankRates.rate.
+        Количество дней делится в DOUBLE (86400e0): деление DECIMAL округлило бы его до 4 знаков.
+        """
+        q = """
+            SELECT b.*, COALESCE(r.rate, %s) AS ownerPercent,
+                TRUNCATE(b.balance * POW(1 + COALESCE(r.rate, %s) / 100,
+                                         TIMESTAMPDIFF(SECOND, b.created, NOW()) / 86400e0), 0)
+                    AS unbankSum
+            FROM banks b
+            LEFT JOIN (
+                SELECT u.user_id, u.extra_percent + %s + COALESCE(t.level, 0) AS rate
+                FROM users u
+                LEFT JOIN teams t ON t.team_id = u.team_id
+            ) r ON r.user_id = b.user_id
+            WHERE b.status = 1
+            ORDER BY unbankSum DESC
+            LIMIT %s;
+        """
+        default_rate = config.BET_BANK_DAILY_DEFAULT
+        banks = await self._execute(q, (default_rate, default_rate, default_rate, limit))
+        for bank in banks:
+            bank["unbankSum"] = int(bank["unbankSum"])
+            bank["ownerPercent"] = int(bank["ownerPercent"])
+        return list(banks)
+
     async def get_user_banks(self, user, banks: list | None = None) -> list:
         if banks:
             user_banks = [bank for bank in banks if bank["user_id"] == user.user_id]
         else:
-            cond = f"user_id = {user.user_id} AND status = 1"
+            cond = "user_id = %s AND status = 1"
 
-            user_banks = list(await self._select(Tables.banks, where=cond))
+            user_banks = list(await self._select(Tables.banks, where=cond, params=(user.user_id,)))
+            user_percent = await self.get_bank_rate(user.user_id)
 
-            for bank in user_banks:
-                bank["unbankSum"] = utils.calc_bank_balance(bank["balance"], await user.get_bank_percent(), bank["created"])
+            values = utils.calc_bank_balances([bank["balance"] for bank in user_banks],
+                                              [user_percent] * len(user_banks),
+                                              [bank["created"] for bank in user_banks])
+            for bank, value in zip(user_banks, values):
+                bank["unbankSum"] = value
 
             user_banks.sort(key=lambda x: x["unbankSum"], reverse=True)
         return user_banks
 
     async def get_bank_by_id(self, bank_id: int) -> dict:
         try:
-            cond = f"account_id = {bank_id} AND status = 1"
-            return await self._select_one(Tables.banks, where=cond)
+            cond = "account_id = %s AND status = 1"
+            return await self._select_one(Tables.banks, where=cond, params=(bank_id,))
         except:
             return {}
 
@@ -554,6 +2111,7 @@ class Storage:
             "balance": amount
         }
         await self._insert(Tables.banks, payload)
+        self._balance_changed(BalanceEvent(user.user_id, banks=amount))
         # Уменьшаем баланс.
         await self.decrease_user_balance(user.user_id, amount_with_fee)
 
@@ -561,15 +2119,23 @@ class Storage:
         payload = {
             "agreed": new_value
         }
-        await self._update(Tables.users, payload, f"user_id = {user.user_id}")
+        await self._update(Tables.users, payload, "user_id = %s", (user.user_id,))
+        self._users_changed(user.user_id)
+        if not new_value:
+            self._balance_changed(BalanceEvent(user.user_id, kind=BalanceEventKind.remove))
+        elif user.balance is not None and not user.banned:
+            # Счетов у нового участника рейтинга еще нет.
+            self._balance_changed(BalanceEvent(user.user_id, coins=user.balance, crystals=user.crystals or 0,
+                                               kind=BalanceEventKind.add))
 
     async def change_bank_password(self, user_id: int, old_password: str, new_password: str, fee: int) -> dict | None:
         old_password = old_password.lower()
         new_password = new_password.lower()
 
-        bank_condition = f"a_password = {self.cnv(old_password)} AND status = 1"
-        if await self._exists(Tables.banks, bank_condition):
-            bank = await self._select_one(Tables.banks, where=bank_condition)
+        bank_condition = "a_password = %s AND status = 1"
+        bank_params = (old_password,)
+        if await self._exists(Tables.banks, bank_condition, bank_params):
+            bank = await self._select_one(Tables.banks, where=bank_condition, params=bank_params)
             if bank:
                 # Снимаем кристаллы.
                 await self.remove_user_crystals(user_id, config.PRICE_CHANGE_BANK_CRYSTALS)
@@ -577,7 +2143,7 @@ class Storage:
                 payload = {
                     "a_password": new_password
                 }
-                await self._update(Tables.banks, payload, bank_condition)
+                await self._update(Tables.banks, payload, bank_condition, bank_params)
 
                 return bank
             else:
@@ -589,31 +2155,39 @@ class Storage:
 
     async def relink_bank(self, user_id: int, password: str) -> dict:
         password = password.lower()
-        bank_condition = f"a_password = {self.cnv(password)} AND status = 1"
-        if await self._exists(Tables.banks, bank_condition):
+        bank_condition = "a_password = %s AND status = 1"
+        bank_params = (password,)
+        if await self._exists(Tables.banks, bank_condition, bank_params):
             await self.remove_user_crystals(user_id, config.PRICE_LINK_CRYSTALS)
             await self.add_payment(user_id, None, PaymentType.relink_bank, config.PRICE_LINK_CRYSTALS, Currency.crystals)
 
-            bank = await self._select_one(Tables.banks, where=bank_condition)
+            bank = await self._select_one(Tables.banks, where=bank_condition, params=bank_params)
 
             payload = {
                 "user_id": user_id
             }
-            await self._update(Tables.banks, payload, bank_condition)
+            await self._update(Tables.banks, payload, bank_condition, bank_params)
+
+            # Счет переходит к новому владельцу вместе с его ставкой.
+            old_value, new_value = utils.calc_bank_balances(
+                [int(bank["balance"])] * 2,
+                [await self.get_bank_rate(bank["user_id"]), await self.get_bank_rate(user_id)],
+                [bank["created"]] * 2)
+            self._balance_changed(BalanceEvent(bank["user_id"], banks=-old_value))
+            self._balance_changed(BalanceEvent(user_id, banks=new_value))
             return bank
         return {}
 
     async def get_bank_by_password(self, user, password: str, fee: int) -> dict | None:
         password = password.lower()
-        bank_condition = f"a_password = {self.cnv(password)} AND status = 1"
-        if await self._exists(Tables.banks, bank_condition):
-            bank = await self._select_one(Tables.banks, where=bank_condition)
-
-            bank_owner = entities.User(user.get_storage(), bank['user_id'])
-            await bank_owner.load_from_db()
+        bank_condition = "a_password = %s AND status = 1"
+        bank_params = (password,)
+        if await self._exists(Tables.banks, bank_condition, bank_params):
+            bank = await self._select_one(Tables.banks, where=bank_condition, params=bank_params)
 
             # Вычисляем сумму для начисления.
-            unbank_sum = utils.calc_bank_balance(int(bank["balance"]), await bank_owner.get_bank_percent(), bank["created"])
+            bank_percent = await self.get_bank_rate(bank["user_id"])
+            unbank_sum = utils.calc_bank_balance(int(bank["balance"]), bank_percent, bank["created"])
             bank["unbankSum"] = unbank_sum
 
             return bank
@@ -624,46 +2198,55 @@ class Storage:
 
     async def unbank_by_password(self, user, password: str, fee: int) -> dict | None:
         password = password.lower()
-        bank_condition = f"a_password = {self.cnv(password)} AND status = 1"
-        if await self._exists(Tables.banks, bank_condition):
-            bank = await self._select_one(Tables.banks, where=bank_condition)
-
-            if bank:
-                # Снимаем кристаллы.
-                await self.remove_user_crystals(user.user_id, config.PRICE_UNBANK_CRYSTALS)
-                # Регистрируем платеж.
-                await self.add_payment(user.user_id, None, PaymentType.unbank, config.PRICE_UNBANK_CRYSTALS, Currency.crystals)
-
-                bank_owner = entities.User(user.get_storage(), bank['user_id'])
-                await bank_owner.load_from_db()
-
-                # Вычисляем сумму для начисления.
-                unbank_sum = utils.calc_bank_balance(int(bank["balance"]), await bank_owner.get_bank_percent(), bank["created"])
-                bank["unbankSum"] = unbank_sum
-
-                # Деактивируем запись о счете.
-                payload = {
-                    "status": False
-                }
-                await self._update(Tables.banks, payload, bank_condition)
-
-                # Увеличиваем баланс пользователя.
-                await self.increase_user_balance(user.user_id, unbank_sum)
-
-                return bank
+        bank_condition = "a_password = %s AND status = 1"
+        bank_params = (password,)
+        # Ставки загружаются до транзакции, чтобы не читать их на ее соединении.
+        await self._load_bank_rates()
+        async with self.transaction():
+            if await self._exists(Tables.banks, bank_condition, bank_params):
+                # Блокируем счет до конца транзакции, чтобы его нельзя было снять дважды.
+                bank = await self._select_one(Tables.banks, where=bank_condition, params=bank_params,
+                                              for_update=True)
+
+                if bank:
+                    # Снимаем кристаллы.
+                    await self.remove_user_crystals(user.user_id, config.PRICE_UNBANK_CRYSTALS)
+                    # Регистрируем платеж.
+                    await self.add_payment(user.user_id, None, PaymentType.unbank, config.PRICE_UNBANK_CRYSTALS, Currency.crystals)
+
+                    # Вычисляем сумму для начисления.
+                    bank_percent = await self.get_bank_rate(bank["user_id"])
+                    unbank_sum = utils.calc_bank_balance(int(bank["balance"]), bank_percent, bank["created"])
+                    bank["unbankSum"] = unbank_sum
+
+                    # Деактивируем запись о счете.
+                    payload = {
+                        "status": False
+                    }
+                    await self._update(Tables.banks, payload, bank_condition, bank_params)
+                    self._balance_changed(BalanceEvent(bank["user_id"], banks=-unbank_sum))
+
+                    # Увеличиваем баланс пользователя.
+                    await self.increase_user_balance(user.user_id, unbank_sum)
+
+                    return bank
+                else:
+                    raise
             else:
-                raise
-        else:
-            # Снимаем комиссию с пользователя.
-            await self.decrease_user_balance(user.user_id, fee)
+                # Снимаем комиссию с пользователя.
+                await self.decrease_user_balance(user.user_id, fee)
 
     async def ban_user(self, user):
         payload = {
             "banned": True,
             "team_id": None
         }
-        cond = f"user_id = {user.user_id}"
-        await self._update(Tables.users, payload, cond)
+        await self._update(Tables.users, payload, "user_id = %s", (user.user_id,))
+        self._users_changed(user.user_id)
+        self._groups_changed()
+        self._bank_rates_changed(functools.partial(self.bank_rates.set_team, user.user_id, None))
+        self.last_seen.remove(user.user_id)
+        self._balance_changed(BalanceEvent(user.user_id, kind=BalanceEventKind.remove))
 
     async def mute_user(self, user, muted_till: int | datetime.datetime):
         if isinstance(muted_till, int):
@@ -672,22 +2255,66 @@ class Storage:
         payload = {
             "muted": muted_till
         }
-        cond = f"user_id = {user.user_id}"
-        await self._update(Tables.users, payload, cond)
+        await self._update(Tables.users, payload, "user_id = %s", (user.user_id,))
+        self._users_changed(user.user_id)
 
     async def unmute_user(self, user):
-        q = f"""
+        q = """
             UPDATE users
             SET muted = '2000-01-01 01:00:00'
-            WHERE user_id = {user.user_id};
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (user.user_id,))
+        self._users_changed(user.user_id)
 
     async def get_users(self) -> tuple:
+        await self.flush_balance_deltas()
+
         keys = ["user_id", "username", "first_name", "last_name", "balance", "team_id", "extra_percent", "protect_level", "crystals"]
-        cond = f"banned = 0 AND agreed = 1"
+        cond = "banned = 0 AND agreed = 1"
         return await self._select(Tables.users, keys, cond)
 
+    async def iter_users(self, chunk_size: int = STREAM_CHUNK_SIZE) -> typing.AsyncIterator[dict]:
+        """
+        То же, что и get_users, но постранично (по user_id): в памяти держится одна страница,
+        соединение между страницами не удерживается, поэтому обработка может быть сколь угодно долгой.
+        """
+        await self.flush_balance_deltas()
+
+        q = """
+            SELECT user_id, username, first_name, last_name, balance, team_id, extra_percent, protect_level, crystals
+            FROM users
+            WHERE banned = 0 AND agreed = 1 AND user_id > %s
+            ORDER BY user_id
+            LIMIT %s;
+        """
+        last_id = -1
+        while True:
+            page = await self._execute(q, (last_id, chunk_size))
+            for row in page:
+                # Изменения, отложенные после начала обхода, тоже учитываем.
+                yield self._apply_balance_deltas(row)
+
+            if len(page) < chunk_size:
+                return
+            last_id = page[-1]["user_id"]
+
+    async def get_daily_fee_summary(self) -> dict:
+        """Количество пользователей для ежедневного сбора и сколько из них не смогут его оплатить."""
+        await self.flush_balance_deltas()
+
+        q = """
+            SELECT COUNT(*) AS total,
+                   COALESCE(SUM(balance <> 0 AND balance < %s AND COALESCE(team_id, 0) = 0), 0) AS will_bad
+            FROM users
+            WHERE banned = 0 AND agreed = 1;
+        """
+        row = (await self._execute(q, (config.PRICE_CHAT_DAILY,)))[0]
+        return {
+            "total": int(row["total"]),
+            "will_bad": int(row["will_bad"])
+        }
+
     async def get_random_users(self, number: int) -> tuple:
         users = list(await self.get_users())
         random.shuffle(users)
@@ -713,39 +2340,35 @@ class Storage:
         await self._insert(Tables.transfers, payload)
 
     async def send(self, from_user, to_user, amount: int, fee_sum: int, comment: str | None) -> int:
-        # Уменьшаем баланс пользователя.
-        await self.decrease_user_balance(from_user.user_id, int(amount + fee_sum))
-
-        # Увеличиваем баланс пользователя.
-        await self.increase_user_balance(to_user.user_id, amount)
-        # Записываем перевод в БД.
-        if not comment:
-            comment = None
-        payload = {
-            "to_id": to_user.user_id,
-            "from_id": from_user.user_id,
-            "amount": int(amount),
-            "fee_sum": int(fee_sum),
-            "currency": Currency.coins,
-            "t_comment": comment
-        }
-        await self._insert(Tables.transfers, payload)
-        # Получаем ID транзакции.
-        q = f"""
-            SELECT transfer_id FROM transfers
-            WHERE to_id = {to_user.user_id} AND from_id = {from_user.user_id} AND
-                amount = {int(amount)} AND fee_sum = {int(fee_sum)}
-            ORDER BY transfer_id DESC LIMIT 1;
-        """
-        return int((await self._execute(q))[0]["transfer_id"])
+        async with self.transaction():
+            # Уменьшаем баланс пользователя.
+            await self.decrease_user_balance(from_user.user_id, int(amount + fee_sum))
+
+            # Увеличиваем баланс пользователя.
+            await self.increase_user_balance(to_user.user_id, amount)
+            # Записываем перевод в БД.
+            if not comment:
+                comment = None
+            payload = {
+                "to_id": to_user.user_id,
+                "from_id": from_user.user_id,
+                "amount": int(amount),
+                "fee_sum": int(fee_sum),
+                "currency": Currency.coins,
+                "t_comment": comment
+            }
+            # Получаем ID транзакции.
+            return int(await self._insert(Tables.transfers, payload))
 
     async def get_total_balance(self) -> int:
+        await self.flush_balance_deltas()
+
         now = datetime.datetime.now()
-        q = f"""
+        q = """
             SELECT SUM(balance) as total_balance FROM users
-            WHERE agreed = 1 AND banned = 0 AND muted <= '{now}';
+            WHERE agreed = 1 AND banned = 0 AND muted <= %s;
         """
-        return int((await self._execute(q))[0]["total_balance"])
+        return int((await self._execute(q, (now,)))[0]["total_balance"])
 
     async def report_user(self, from_user, to_user, comment: str | None):
         # Начисляем вознаграждение.
@@ -763,15 +2386,16 @@ class Storage:
             "r_comment": comment
         }
         await self._insert(Tables.reports, payload)
+        self.cooldowns.add_report(from_user.user_id, to_user.user_id, datetime.datetime.now())
 
     async def remove_user_reports(self, user):
-        cond = f"to_id = {user.user_id}"
-        await self._delete(Tables.reports, cond, HIGH_LIMIT)
+        await self._delete(Tables.reports, "to_id = %s", (user.user_id,), HIGH_LIMIT)
+        self.cooldowns.remove_reports_to(user.user_id)
 
     async def get_reports_sum(self, user) -> dict:
         try:
             keys = ["from_balance"]
-            reports = await self._select(Tables.reports, keys, f"to_id = {user.user_id}")
+            reports = await self._select(Tables.reports, keys, "to_id = %s", (user.user_id,))
 
             total_sum = 0
             for report in reports:
@@ -789,42 +2413,64 @@ class Storage:
 
     async def get_users_count(self, include_muted: bool = False) -> int:
         now = datetime.datetime.now()
-        extra_string = "" if include_muted else f"AND muted <= '{now}'"
-        q = f"""
-            SELECT COUNT(*) as users_count FROM users
-            WHERE agreed = 1 AND banned = 0 {extra_string};
-        """
-        return int((await self._execute(q))[0]["users_count"])
+        if include_muted:
+            q = """
+                SELECT COUNT(*) as users_count FROM users
+                WHERE agreed = 1 AND banned = 0;
+            """
+            params = ()
+        else:
+            q = """
+                SELECT COUNT(*) as users_count FROM users
+                WHERE agreed = 1 AND banned = 0 AND muted <= %s;
+            """
+            params = (now,)
+        return int((await self._execute(q, params))[0]["users_count"])
 
     async def get_last_poll_time(self, user) -> datetime.datetime | None:
+        if self.cooldowns.loaded:
+            poll = self.cooldowns.last_poll(user.user_id)
+            return poll["created"] if poll else None
+
         try:
-            q = f"""
+            q = """
                 SELECT created, poll_id FROM polls
-                WHERE to_id = {user.user_id}
+                WHERE to_id = %s
                 ORDER BY poll_id DESC LIMIT 1;
             """
-            return (await self._execute(q))[0]["created"]
+            return (await self._execute(q, (user.user_id,)))[0]["created"]
         except:
             return None
 
     async def get_last_report_time(self, user) -> datetime.datetime | None:
+        if self.cooldowns.loaded:
+            return self.cooldowns.last_report(user.user_id)
+
         try:
-            q = f"""
+            q = """
                 SELECT report_id, created FROM reports
-                WHERE from_id = {user.user_id}
+                WHERE from_id = %s
                 ORDER BY report_id DESC LIMIT 1;
             """
-            return (await self._execute(q))[0]["created"]
+            return (await self._execute(q, (user.user_id,)))[0]["created"]
         except:
             return None
 
     async def get_poll(self, poll_id: int, stage: int) -> dict:
-        return await self._select_one(Tables.polls, where=f"poll_id = {poll_id} AND stage = {stage}")
+        poll = self.cooldowns.polls.get(poll_id)
+        if poll and poll["stage"] == stage:
+            return dict(poll)
+        return await self._select_one(Tables.polls, where="poll_id = %s AND stage = %s", params=(poll_id, stage))
+
+    async def has_voted(self, user, poll_id: int, stage: int) -> bool:
+        if self.cooldowns.loaded and poll_id in self.cooldowns.polls:
+            return (poll_id, stage, user.user_id) in self.cooldowns.votes
+        return bool(await self.get_vote(user, poll_id, stage))
 
     async def get_vote(self, user, poll_id: int, stage: int) -> dict:
         try:
-            cond = f"poll_id = {poll_id} AND user_id = {user.user_id} AND stage = {stage}"
-            return await self._select_one(Tables.votes, where=cond)
+            cond = "poll_id = %s AND user_id = %s AND stage = %s"
+            return await self._select_one(Tables.votes, where=cond, params=(poll_id, user.user_id, stage))
         except:
             return {}
 
@@ -837,6 +2483,7 @@ class Storage:
             "from_balance": user.balance
         }
         await self._insert(Tables.votes, payload)
+        self.cooldowns.votes.add((poll_id, stage, user.user_id))
 
     async def finish_poll(self, poll_id: int, win_decision_1: str, win_decision_2: str | None):
         payload = {
@@ -844,7 +2491,9 @@ class Storage:
             "win_decision_1": win_decision_1,
             "win_decision_2": win_decision_2
         }
-        await self._update(Tables.polls, payload, f"poll_id = {poll_id}")
+        await self._update(Tables.polls, payload, "poll_id = %s", (poll_id,))
+        if poll_id in self.cooldowns.polls:
+            self.cooldowns.polls[poll_id]["stage"] = 3
 
     async def register_poll(self, user) -> int:
         # Регистриуем новый опрос.
@@ -852,29 +2501,27 @@ class Storage:
         payload = {
             "to_id": user.user_id
         }
-        await self._insert(table, payload)
-
-        # Получаем ID опроса.
-        q = f"""
-            SELECT poll_id FROM polls
-            WHERE to_id = {user.user_id} AND stage = 1
-            ORDER BY poll_id DESC LIMIT 1;
-        """
-        poll_id = int((await self._execute(q))[0]["poll_id"])
+        poll_id = int(await self._insert(table, payload))
+        self.cooldowns.add_poll(poll_id, user.user_id, datetime.datetime.now())
 
         # Удаляем все жалобы.
-        await self._delete(Tables.reports, f"to_id = {user.user_id}", HIGH_LIMIT)
+        await self._delete(Tables.reports, "to_id = %s", (user.user_id,), HIGH_LIMIT)
+        self.cooldowns.remove_reports_to(user.user_id)
 
         return poll_id
 
     async def get_last_finished_poll_time(self, user) -> datetime.datetime | None:
+        if self.cooldowns.loaded:
+            poll = self.cooldowns.last_poll(user.user_id, stage=1)
+            return poll["created"] if poll else None
+
         try:
-            q = f"""
+            q = """
                 SELECT * FROM polls
-                WHERE to_id = {user.user_id} AND stage = 1
+                WHERE to_id = %s AND stage = 1
                 ORDER BY created DESC LIMIT 1;
             """
-            return (await self._execute(q))[0]["created"]
+            return (await self._execute(q, (user.user_id,)))[0]["created"]
         except:
             return None
 
@@ -884,8 +2531,8 @@ class Storage:
         :param stage:
         :return: {"balances": {decision: total_balance}, "count": {decision: total_count}}
         """
-        cond = f"poll_id = {poll_id} AND stage = {stage}"
-        votes = await self._select(Tables.votes, where=cond)
+        cond = "poll_id = %s AND stage = %s"
+        votes = await self._select(Tables.votes, where=cond, params=(poll_id, stage))
 
         print(f"votes: {votes}")
 
@@ -939,37 +2586,25 @@ class Storage:
             return {}
 
     async def get_worst_balances(self) -> list:
-        q = """
-            SELECT balance FROM users
-            WHERE banned = 0 AND agreed = 1
-            ORDER BY balance
-            LIMIT 10;
-        """
-        r = await self._execute(q)
-        balances = [row['balance'] for row in r]
-        return balances
+        return (await self._load_rankings()).coins.bottom(10)
 
     async def get_top_balances(self) -> list:
+        if self._rankings_ready():
+            return self.rankings.wealth.top()
+
         users = await self.get_top_users()
         balances = [row['balance'] for row in users]
         return balances
 
     async def get_top_crystal_balances(self) -> list:
-        q = """
-            SELECT crystals FROM users
-            WHERE banned = 0 AND agreed = 1
-            ORDER BY crystals DESC;
-        """
-        r = await self._execute(q)
-        balances = [row['crystals'] for row in r]
-        return balances
+        return (await self._load_rankings()).crystals.top()
 
     async def get_disagreed_users(self) -> list:
         now = datetime.datetime.now()
         then = now - datetime.timedelta(seconds=config.TIME_TO_AGREED)
-        cond = f"banned = 0 AND agreed = 0 AND created <= '{then}'"
+        cond = "banned = 0 AND agreed = 0 AND created <= %s"
 
-        rows = await self._select(Tables.users, ["user_id"], where=cond)
+        rows = await self._select(Tables.users, ["user_id"], where=cond, params=(then,))
         users = [x["user_id"] for x in rows]
 
         return users
@@ -977,29 +2612,31 @@ class Storage:
     async def get_inactive_users(self) -> list:
         now = datetime.datetime.now()
         then = now - datetime.timedelta(seconds=config.TIME_USER_MAX_INACTIVE)
-        cond = f"banned = 0 AND updated < '{then}'"
+        if self.last_seen.loaded:
+            return self.last_seen.inactive(then)
 
-        rows = await self._select(Tables.users, ["user_id"], where=cond)
+        cond = "banned = 0 AND updated < %s"
+        await self.flush_activity()
+
+        rows = await self._select(Tables.users, ["user_id"], where=cond, params=(then,))
         users = [x["user_id"] for x in rows]
 
         return users
 
     async def get_top_users(self, banks: list | None = None) -> list:
+        await self.flush_balance_deltas()
+
         q = """
             SELECT user_id, balance FROM users
             WHERE banned = 0 AND agreed = 1
             ORDER BY balance DESC;
         """
-        users = list(await self._execute(q))
+        users = [user_note async for user_note in self._iterate(q)]
 
         if not banks:
             banks = await self.get_top_banks()
 
-        for user_note in users:
-            for bank in banks:
-                if bank["user_id"] == user_note["user_id"]:
-                    unbank_sum = bank["unbankSum"]
-                    user_note["balance"] = int(user_note["balance"] + unbank_sum)
+        utils.add_banks_to_balances(users, banks)
 
         users.sort(key=lambda x: x["balance"], reverse=True)
 
@@ -1007,20 +2644,61 @@ class Storage:
 
     async def get_top_place_info(self, user) -> dict:
         try:
-            banks = await self.get_top_banks()
-            users = await self.get_top_users(banks)
-
-            uids = [row['user_id'] for row in users]
-
+            # Место и количество участников - из рейтинга в памяти, счета - только самого пользователя.
+            rankings = await self._load_rankings()
+            place = rankings.wealth.place(user.user_id)
+            assert place, "Пользователь не участвует в рейтинге"
             return {
-                "place": uids.index(user.user_id) + 1,
-                "total": len(uids),
-                "users": users,
-                "banks": banks
+                "place": place,
+                "total": len(rankings.wealth),
+                "banks": await self.get_user_banks(user)
             }
         except:
             return {}
 
+    async def refresh_rankings(self, reconcile: bool = False):
+        """
+        Пересчитывает суммы счетов в рейтингах (проценты по ним начисляются без событий).
+        :param reconcile: также сверить балансы и кристаллы участников с БД.
+        """
+        if not self.rankings.fresh:
+            await self.load_rankings()
+            return
+
+        async with self.rankings_lock:
+            self.rankings.begin_refresh()
+            try:
+                users = None
+                if reconcile:
+                    await self.flush_balance_deltas()
+                    rows = await self._select_rows(Tables.users, ("user_id", "balance", "crystals"),
+                                                   "banned = 0 AND agreed = 1")
+                    users = [self._apply_balance_deltas(row) for row in rows]
+                bank_totals = utils.sum_banks_by_owner(await self.get_top_banks())
+
+                # Пока шло чтение, рейтинги могли сбросить после отмененной транзакции.
+                if not self.rankings.fresh:
+                    return
+                if reconcile:
+                    self.rankings.reconcile(users, bank_totals)
+                else:
+                    self.rankings.refresh_banks(bank_totals)
+            finally:
+                self.rankings.end_refresh()
+
+    async def process_rankings(self):
+        """Фоновый пересчет сумм счетов в рейтингах и периодическая сверка балансов с БД."""
+        last_reconcile = time.monotonic()
+        while True:
+            await asyncio.sleep(config.RANKINGS_BANKS_REFRESH_SECONDS)
+            try:
+                reconcile = time.monotonic() - last_reconcile >= config.RANKINGS_RECONCILE_SECONDS
+                await self.refresh_rankings(reconcile)
+                if reconcile:
+                    last_reconcile = time.monotonic()
+            except Exception as e:
+                print(f"RANKINGS E: {e}")
+
     async def play_game(self, user_id: int, bet_amount: int, profit: int):
         payload = {
             "user_id": user_id,
@@ -1034,8 +2712,8 @@ class Storage:
         :param user_id:
         :return: {"buy": int, "sell": int}
         """
-        cond = f"crystals > 0 AND direction IN ('sell', 'buy') AND user_id = {user_id}"
-        offers = await self._select(Tables.market, where=cond)
+        cond = "crystals > 0 AND direction IN ('sell', 'buy') AND user_id = %s"
+        offers = await self._select(Tables.market, where=cond, params=(user_id,))
 
         buy = 0
         sell = 0
@@ -1053,13 +2731,13 @@ class Storage:
 
     async def get_market_offer(self, offer_id: int) -> dict:
         try:
-            cond = f"crystals > 0 AND offer_id = {offer_id}"
-            return await self._select_one(Tables.market, where=cond)
+            cond = "crystals > 0 AND offer_id = %s"
+            return await self._select_one(Tables.market, where=cond, params=(offer_id,))
         except:
             return {}
 
     async def get_market_offers(self) -> dict:
-        cond = f"crystals > 0 AND direction IN ('sell', 'buy')"
+        cond = "crystals > 0 AND direction IN ('sell', 'buy')"
         offers = await self._select(Tables.market, where=cond)
 
         sell_offers = []
@@ -1087,8 +2765,8 @@ class Storage:
         payload = {
             "crystals": offer['crystals']
         }
-        cond = f"user_id = {offer['user_id']} AND offer_id = {offer['offer_id']}"
-        await self._update(Tables.market, payload, cond)
+        cond = "user_id = %s AND offer_id = %s"
+        await self._update(Tables.market, payload, cond, (offer['user_id'], offer['offer_id']))
 
     async def make_sell_offer(self, user_id: int, crystals: int, price: int):
         # Отбираем кристаллы.
@@ -1103,25 +2781,26 @@ class Storage:
         await self._insert(Tables.market, payload)
 
     async def make_buy_offer(self, user_id: int, crystals: int, price: int):
-        # Отбираем монетки.
-        await self.decrease_user_balance(user_id, int(crystals * price))
-        # Выставляем заявку на покупку.
-        payload = {
-            "user_id": user_id,
-            "crystals": crystals,
-            "price": price,
-            "direction": MarketDirection.buy
-        }
-        await self._insert(Tables.market, payload)
+        async with self.transaction():
+            # Отбираем монетки.
+            await self.decrease_user_balance(user_id, int(crystals * price))
+            # Выставляем заявку на покупку.
+            payload = {
+                "user_id": user_id,
+                "crystals": crystals,
+                "price": price,
+                "direction": MarketDirection.buy
+            }
+            await self._insert(Tables.market, payload)
 
     async def return_market_crystals(self, user_id: int) -> int:
-        offers_cond = f"crystals > 0 AND user_id = {user_id} AND direction = 'sell'"
-        offers = await self._select(Tables.market, where=offers_cond)
+        offers_cond = "crystals > 0 AND user_id = %s AND direction = 'sell'"
+        offers = await self._select(Tables.market, where=offers_cond, params=(user_id,))
         if offers:
             payload = {
                 "crystals": 0
             }
-            await self._update(Tables.market, payload, offers_cond)
+            await self._update(Tables.market, payload, offers_cond, (user_id,))
 
             crystals = int(sum([o["crystals"] for o in offers]))
             await self.add_user_crystals(user_id, crystals)
@@ -1131,13 +2810,13 @@ class Storage:
         return 0
 
     async def return_market_coins(self, user_id: int) -> int:
-        offers_cond = f"crystals > 0 AND user_id = {user_id} AND direction = 'buy'"
-        offers = await self._select(Tables.market, where=offers_cond)
+        offers_cond = "crystals > 0 AND user_id = %s AND direction = 'buy'"
+        offers = await self._select(Tables.market, where=offers_cond, params=(user_id,))
         if offers:
             payload = {
                 "crystals": 0
             }
-            await self._update(Tables.market, payload, offers_cond)
+            await self._update(Tables.market, payload, offers_cond, (user_id,))
 
             coins = int(sum([int(o["crystals"] * o["price"]) for o in offers]))
             await self.increase_user_balance(user_id, coins)
@@ -1146,6 +2825,7 @@ class Storage:
 
         return 0
 
+    @single_flight
     async def get_market_total_crystals(self) -> int:
         try:
             q = """
@@ -1172,65 +2852,72 @@ class Storage:
     async def delete_user_reports(self, user_id: int) -> int:
         await self.remove_user_crystals(user_id, config.PRICE_DELETE_REPORTS_CRYSTALS)
 
-        cond = f"to_id = {user_id}"
-        reports = await self._select(Tables.reports, where=cond)
+        cond = "to_id = %s"
+        reports = await self._select(Tables.reports, where=cond, params=(user_id,))
 
         # Регистрируем платеж.
         await self.add_payment(user_id, None, PaymentType.reports_removing, 1, Currency.crystals)
 
         if reports:
-            await self._delete(Tables.reports, where=cond, limit=300)
+            await self._delete(Tables.reports, where=cond, params=(user_id,), limit=300)
+            self.cooldowns.remove_reports_to(user_id)
             return len(reports)
         return 0
 
     async def join_group(self, user_id: int, group_id: int):
-        # Списываем плату.
-        await self.decrease_user_balance(user_id, config.PRICE_JOIN_GROUP)
-        # Регистрируем оплату.
-        await self.add_payment(user_id, None, PaymentType.join_group, config.PRICE_JOIN_GROUP,
-                               Currency.coins)
-
-        # Прописываем пользователя в группу.
-        payload = {
-            "team_id": group_id
-        }
-        cond = f"user_id = {user_id} AND team_id IS NULL"
-        await self._update(Tables.users, payload, cond)
+        async with self.transaction():
+            # Списываем плату.
+            await self.decrease_user_balance(user_id, config.PRICE_JOIN_GROUP)
+            # Регистрируем оплату.
+            await self.add_payment(user_id, None, PaymentType.join_group, config.PRICE_JOIN_GROUP,
+                                   Currency.coins)
+
+            # Прописываем пользователя в группу.
+            payload = {
+                "team_id": group_id
+            }
+            cond = "user_id = %s AND team_id IS NULL"
+            await self._update(Tables.users, payload, cond, (user_id,))
+            self._users_changed(user_id)
+            self._groups_changed()
+            self._bank_rates_changed(functools.partial(self.bank_rates.set_team, user_id, group_id))
 
     async def group_exists_by_name(self, group_name: str) -> bool:
-        cond = f"caption = {self.cnv(group_name)}"
-        return await self._exists(Tables.teams, cond)
+        return await self._exists(Tables.teams, "caption = %s", (group_name,))
 
     async def group_exists_by_id(self, group_id: int) -> bool:
-        cond = f"team_id = {group_id} AND leader_id IS NOT NULL"
-        return await self._exists(Tables.teams, cond)
+        cond = "team_id = %s AND leader_id IS NOT NULL"
+        return await self._exists(Tables.teams, cond, (group_id,))
 
     async def create_group(self, leader_id: int, caption: str):
-        # Списываем плату.
-        await self.decrease_user_balance(leader_id, config.PRICE_CREATE_GROUP)
-        await self.remove_user_crystals(leader_id, config.PRICE_CREATE_GROUP_CRYSTALS)
-
-        # Регистрируем оплату.
-        await self.add_payment(leader_id, None, PaymentType.create_group, config.PRICE_CREATE_GROUP,
-                               Currency.coins)
-        await self.add_payment(leader_id, None, PaymentType.create_group, config.PRICE_CREATE_GROUP_CRYSTALS,
-                               Currency.crystals)
-
-        # Создаем организацию.
-        payload = {
-            "caption": caption,
-            "leader_id": leader_id
-        }
-        await self._insert(Tables.teams, payload)
-
-        # Получаем ID созданной группы.
-        team_id = int((await self._select_one(Tables.teams, ["team_id"], f"leader_id = {leader_id}"))["team_id"])
+        async with self.transaction():
+            # Списываем плату.
+            await self.decrease_user_balance(leader_id, config.PRICE_CREATE_GROUP)
+            await self.remove_user_crystals(leader_id, config.PRICE_CREATE_GROUP_CRYSTALS)
+
+            # Регистрируем оплату.
+            await self.add_payment(leader_id, None, PaymentType.create_group, config.PRICE_CREATE_GROUP,
+                                   Currency.coins)
+            await self.add_payment(leader_id, None, PaymentType.create_group, config.PRICE_CREATE_GROUP_CRYSTALS,
+                                   Currency.crystals)
+
+            # Создаем организацию.
+            payload = {
+                "caption": caption,
+                "leader_id": leader_id
+            }
+            # Получаем ID созданной группы.
+            team_id = int(await self._insert(Tables.teams, payload))
 
-        # Помещаем пользователя в нее.
-        update_payload = {
-            "team_id": team_id
-        }
-        await self._update(Tables.users, update_payload, f"user_id = {leader_id}")
+            # Помещаем пользователя в нее.
+            update_payload = {
+                "team_id": team_id
+            }
+            await self._update(Tables.users, update_payload, "user_id = %s", (leader_id,))
+            self._users_changed(leader_id)
+            self._groups_changed()
+            # Уровень новой группы задается БД, поэтому ставки перечитываются.
+            self._invalidate(self.bank_rates.invalidate)
 
     async def rename_group(self, leader_id: int, new_caption: str):
         # Списываем плату.
@@ -1242,39 +2929,46 @@ class Storage:
         payload = {
             "caption": new_caption
         }
-        await self._update(Tables.teams, payload, f"leader_id = {leader_id}")
+        await self._update(Tables.teams, payload, "leader_id = %s", (leader_id,))
+        self._groups_changed()
 
     async def exit_group(self, user_id: int, group_id: int):
-        cond = f"user_id = {user_id} AND team_id = {group_id}"
+        cond = "user_id = %s AND team_id = %s"
         payload = {
             "team_id": None
         }
-        await self._update(Tables.users, payload, cond)
+        await self._update(Tables.users, payload, cond, (user_id, group_id))
+        self._users_changed(user_id)
+        self._groups_changed()
+        self._bank_rates_changed(functools.partial(self.bank_rates.set_team, user_id, None))
 
     async def delete_group(self, group_id: int):
         if not group_id:
             raise
 
-        cond = f"team_id = {group_id}"
+        cond = "team_id = %s"
+        params = (group_id,)
 
         # Выгоняем всех участников из группы.
         payload = {
             "team_id": None
         }
-        await self._update(Tables.users, payload, cond)
+        await self._update(Tables.users, payload, cond, params)
+        self._team_users_changed(group_id)
+        self._bank_rates_changed(functools.partial(self.bank_rates.remove_team, group_id))
 
         # Удаляем лидера из группы.
         payload = {
             "leader_id": None
         }
-        await self._update(Tables.teams, payload, cond)
+        await self._update(Tables.teams, payload, cond, params)
+        self._groups_changed()
 
     async def get_group(self, group_id: int) -> dict:
-        try:
-            cond = f"team_id = {group_id} AND leader_id IS NOT NULL"
-            return await self._select_one(Tables.teams, where=cond)
-        except:
+        info = (await self._load_groups()).teams.get(group_id)
+        if not info or info["leader_id"] is None:
             return {}
+        return dict(info)
 
     async def get_group_level(self, group_id: int | None) -> int:
         try:
@@ -1285,11 +2979,16 @@ class Storage:
             return 0
 
     async def get_groups(self) -> tuple:
-        cond = "level >= 1 AND leader_id IS NOT NULL"
-        return await self._select(Tables.teams, where=cond)
+        teams = (await self._load_groups()).teams.values()
+        return tuple(dict(team) for team in teams if team["level"] >= 1 and team["leader_id"] is not None)
 
-    async def get_group_members(self, group_id: int) -> tuple:
-        return await self._select(Tables.users, where=f"team_id = {group_id}")
+    async def get_group_member_ids(self, group_id: int) -> frozenset[int]:
+        return (await self._load_groups()).members.get(group_id, frozenset())
+
+    async def get_group_members(self, group_id: int) -> tuple[Row]:
+        await self.flush_balance_deltas()
+
+        return tuple(await self._select_rows(Tables.users, USER_PROFILE_KEYS, "team_id = %s", (group_id,)))
 
     async def upgrade_group_level(self, group) -> int:
         new_level = int(group.level + 1)
@@ -1297,27 +2996,31 @@ class Storage:
         price_coins = price["coins"]
         price_crystals = price["crystals"]
 
-        # Списываем и регистрируем оплату.
-        await self.decrease_user_balance(group.leader_id, price_coins)
-        await self.remove_user_crystals(group.leader_id, price_crystals)
-        await self.add_payment(group.leader_id, None, PaymentType.updage_group, price_coins, Currency.coins)
-        await self.add_payment(group.leader_id, None, PaymentType.updage_group, price_crystals, Currency.crystals)
+        async with self.transaction():
+            # Списываем и регистрируем оплату.
+            await self.decrease_user_balance(group.leader_id, price_coins)
+            await self.remove_user_crystals(group.leader_id, price_crystals)
+            await self.add_payment(group.leader_id, None, PaymentType.updage_group, price_coins, Currency.coins)
+            await self.add_payment(group.leader_id, None, PaymentType.updage_group, price_crystals, Currency.crystals)
 
-        # Поднимаем уровень группе.
-        payload = {
-            "level": new_level
-        }
-        cond = f"leader_id = {group.leader_id} AND team_id = {group.group_id}"
-        await self._update(Tables.teams, payload, cond)
+            # Поднимаем уровень группе.
+            payload = {
+                "level": new_level
+            }
+            cond = "leader_id = %s AND team_id = %s"
+            await self._update(Tables.teams, payload, cond, (group.leader_id, group.group_id))
+            self._groups_changed()
+            self._bank_rates_changed(functools.partial(self.bank_rates.set_level, group.group_id, new_level))
 
-        return new_level
+            return new_level
 
     async def set_group_tax(self, group, new_tax_value: int):
         payload = {
             "tax": new_tax_value
         }
-        cond = f"leader_id = {group.leader_id} AND team_id = {group.group_id}"
-        await self._update(Tables.teams, payload, cond)
+        cond = "leader_id = %s AND team_id = %s"
+        await self._update(Tables.teams, payload, cond, (group.leader_id, group.group_id))
+        self._groups_changed()
 
     async def upgrade_user_protection(self, user_id: int, price: int):
         # Списываем кристаллы.
@@ -1327,24 +3030,27 @@ class Storage:
                                price, Currency.crystals)
 
         # Увеличиваем процент в банке.
-        q = f"""
+        q = """
             UPDATE users
             SET protect_level = protect_level + 1
-            WHERE user_id = {user_id};
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (user_id,))
+        self._users_changed(user_id)
 
     async def deupgrade_user_bank(self, user_id: int, price: int):
         # Списываем кристаллы.
         await self.add_user_crystals(user_id, price)
 
         # Увеличиваем процент в банке.
-        q = f"""
+        q = """
             UPDATE users
             SET extra_percent = extra_percent - 1
-            WHERE user_id = {user_id};
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (user_id,))
+        self._users_changed(user_id)
+        self._bank_rates_changed(functools.partial(self.bank_rates.add_extra, user_id, -1))
 
     async def upgrade_user_bank(self, user_id: int, price: int):
         # Списываем кристаллы.
@@ -1354,12 +3060,14 @@ class Storage:
                                price, Currency.crystals)
 
         # Увеличиваем процент в банке.
-        q = f"""
+        q = """
             UPDATE users
             SET extra_percent = extra_percent + 1
-            WHERE user_id = {user_id};
+            WHERE user_id = %s;
         """
-        await self._execute(q)
+        await self._execute(q, (user_id,))
+        self._users_changed(user_id)
+        self._bank_rates_changed(functools.partial(self.bank_rates.add_extra, user_id, 1))
 
     async def add_hack_attempt(self, user_id: int, bank_id: int, mb_password: str, bank_password: str,
                                successfully: bool):
@@ -1373,10 +3081,8 @@ class Storage:
         await self._insert(Tables.hacks, payload)
 
     async def get_msg_codes(self) -> list:
-        keys = ['msg_code']
-        raw_codes = await self._select(Tables.users, keys)
-        codes = [r['msg_code'] for r in raw_codes if r['msg_code']]
-        return codes
+        q = "SELECT msg_code FROM users WHERE msg_code IS NOT NULL AND msg_code != '';"
+        return [msg_code async for msg_code, in self._iterate(q, raw=True)]
 
     async def set_user_msg_code(self, user_id: int, new_msg_code: str):
         assert len(new_msg_code) == 4, "Неправильная длиная анонимного кода"
@@ -1384,8 +3090,8 @@ class Storage:
         payload = {
             "msg_code": new_msg_code.lower()
         }
-        cond = f"user_id = {user_id}"
-        await self._update(Tables.users, payload, cond)
+        await self._update(Tables.users, payload, "user_id = %s", (user_id,))
+        self._users_changed(user_id)
 
     async def send_message(self, from_id: int, to_id: int, dialog_id: str | None, text: str):
         # Списываем монетки.
@@ -1403,17 +3109,20 @@ class Storage:
         await self._insert(Tables.messages, payload)
 
     async def remove_group(self, leader_id: int, group_id: int):
-        cond = f"leader_id = {leader_id} AND team_id = {group_id}"
+        cond = "leader_id = %s AND team_id = %s"
         payload = {
             "leader_id": None
         }
-        await self._update(Tables.teams, payload, cond)
+        await self._update(Tables.teams, payload, cond, (leader_id, group_id))
 
-        cond = f"team_id = {group_id}"
+        cond = "team_id = %s"
         payload = {
             "team_id": None
         }
-        await self._update(Tables.users, payload, cond)
+        await self._update(Tables.users, payload, cond, (group_id,))
+        self._team_users_changed(group_id)
+        self._groups_changed()
+        self._bank_rates_changed(functools.partial(self.bank_rates.remove_team, group_id))
 
     async def change_user_policy(self, user):
         if user.policy == 1:
@@ -1424,8 +3133,8 @@ class Storage:
         payload = {
             "policy": new_policy
         }
-        cond = f"user_id = {user.user_id}"
-        await self._update(Tables.users, payload, cond)
+        await self._update(Tables.users, payload, "user_id = %s", (user.user_id,))
+        self._users_changed(user.user_id)
 
     async def post_ad(self, user_id: int, text: str):
         # Списываем монетки.
@@ -1,5 +1,3 @@
-import copy
-
 import datetime
 
 import db
@@ -33,14 +31,14 @@ class Group:
         return bool(self.group_id)
 
     async def can_join(self) -> bool:
-        if not self.updated():
-            await self.update()
+        if not self.info_updated():
+            await self.update_info()
 
-        return bool(self.leader_id) and bool(self.members) and (await self.can_invite())
+        return bool(self.leader_id) and bool(await self.get_member_ids()) and (await self.can_invite())
 
     async def get_leader(self):
-        if not self.updated():
-            await self.update()
+        if not self.info_updated():
+            await self.update_info()
 
         return await search_user(self.storage, str(self.leader_id))
 
@@ -66,13 +64,13 @@ class Group:
             self.tax = self.info.get('tax')
 
     async def get_level(self) -> int | None:
-        if not self.updated():
-            await self.update()
+        if not self.info_updated():
+            await self.update_info()
         return self.level
 
     async def get_tax(self) -> int | None:
-        if not self.updated():
-            await self.update()
+        if not self.info_updated():
+            await self.update_info()
         return self.tax
 
     async def get_max_members_count(self) -> int:
@@ -80,9 +78,9 @@ class Group:
 
     async def can_invite(self) -> bool:
         max_count = await self.get_max_members_count()
-        members = await self.get_members()
+        member_ids = await self.get_member_ids()
 
-        return len(members) < max_count
+        return len(member_ids) < max_count
 
     async def update_members(self):
         if self.exists():
@@ -100,9 +98,18 @@ class Group:
 
         return self.members
 
+    async def get_member_ids(self) -> frozenset[int]:
+        """ID участников из индекса в кэше групп (без загрузки профилей участников)."""
+        if not self.exists():
+            return frozenset()
+        return await self.storage.get_group_member_ids(self.group_id)
+
     def updated(self) -> bool:
         return bool(self.leader_id) and bool(self.members)
 
+    def info_updated(self) -> bool:
+        return bool(self.leader_id)
+
     async def get_total_balance(self) -> int:
         # Загружаем участником, если они не загружены.
         if not self.updated():
@@ -111,21 +118,13 @@ class Group:
         return int(sum([member['balance'] for member in self.members]))
 
     async def is_leader(self, user_id: int) -> bool:
-        if not self.updated():
-            await self.update()
+        if not self.info_updated():
+            await self.update_info()
 
         return self.leader_id and self.leader_id == user_id
 
     async def is_member(self, user_id: int) -> bool:
-        if not self.updated():
-            await self.update()
-
-        if not self.members:
-            return False
-
-        ids = [u['user_id'] for u in self.members]
-
-        return user_id in ids
+        return user_id in await self.get_member_ids()
 
     def get_name(self) -> str:
         return self.name.capitalize() if self.name else "-"
@@ -214,15 +213,26 @@ class User:
         return self.storage
 
     async def exists(self) -> bool:
+        # Если пользователь уже загружен через touch, то повторно в БД не ходим.
+        if self.first is not None:
+            return not self.first
         return await self.storage.user_exists(self.user_id)
 
     async def subscribed(self, bot) -> bool:
+        cached = chat_members.get(self.user_id)
+        if cached is not None:
+            return cached
+
         try:
             status = (await bot.get_chat_member(config.CHAT_ID, self.user_id))['status']
-            return status in ("creator", "administrator", "member")
         except:
+            # Ошибку запроса не кэшируем.
             return False
 
+        result = status in ("creator", "administrator", "member")
+        chat_members.set(self.user_id, result)
+        return result
+
     def is_muted(self) -> bool:
         now_time = datetime.datetime.now()
         return self.muted and self.muted.timestamp() > now_time.timestamp() + 60
@@ -230,6 +240,16 @@ class User:
     async def update(self):
         await self.storage.update_user(self)
 
+    async def touch(self, chat_id: int, require_agreed: bool = True, bot=None) -> bool:
+        """
+        Загрузка из БД вместе с обновлением активности. True - пользователь существует.
+        :param bot: для проверки, что пишущий в лс состоит в чате (без него активность в лс не обновляется).
+        """
+        subscribed = True
+        if chat_id == self.user_id and self.user_id not in config.IGNORED_IDS:
+            subscribed = bot is not None and await self.subscribed(bot)
+        return await self.storage.touch_user(self, chat_id, require_agreed, subscribed)
+
     async def load_from_db(self):
         try:
             await self.storage.load_user_from_db(self)
@@ -363,6 +383,9 @@ class User:
     async def get_vote(self, poll_id: int, stage: int) -> dict:
         return await self.storage.get_vote(self, poll_id, stage)
 
+    async def has_voted(self, poll_id: int, stage: int) -> bool:
+        return await self.storage.has_voted(self, poll_id, stage)
+
     async def vote(self, poll_id: int, stage: int, decision: str):
         await self.storage.vote(self, poll_id, stage, decision)
 
@@ -503,22 +526,16 @@ async def search_user(storage: db.Storage, search_text: str) -> User | None:
 
 class TempStorage:
     def __init__(self):
-        self.box = {}
+        self.box = db.ExpiringStore(config.LOCAL_STORE_MAX_SIZE, config.LOCAL_STORE_TTL)
 
-    def value(self, user: int | str | User, key: str, value=None, default_value=None):
+    def value(self, user: int | str | User, key: str, value=None, default_value=None, ttl: int | None = None):
         if isinstance(user, User):
             user = user.user_id
         user = str(user)
         if value is None:
-            return self.box.get(user, {}).get(key, default_value)
+            return self.box.get(user, key, default_value)
         else:
-            if self.box.get(user) is None:
-                self.box[user] = {}
-
-            if isinstance(value, (list, tuple, dict)):
-                value = copy.deepcopy(value)
-
-            self.box[user][key] = value
+            self.box.set(user, key, value, ttl)
 
     def common_value(self, key: str, value: str | None = None, default_value=None):
         return self.value("global", key, value, default_value)
@@ -531,4 +548,29 @@ class TempStorage:
     def reset(self, user: int | str | User):
         if isinstance(user, User):
             user = user.user_id
-        self.box[str(user)] = {}
+        self.box.reset(str(user))
+
+
+class ChatMembers:
+    """
+    Кэш членства пользователей в чате. Обновляется обработчиками входа, выхода и блокировок,
+    а запись без событий живет не дольше ttl секунд (после чего статус снова запрашивается у Telegram).
+    При переполнении вытесняются давно не использованные записи.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self.box = db.ExpiringStore(max_size, ttl)
+
+    def get(self, user_id: int) -> bool | None:
+        return self.box.get(user_id, "member")
+
+    def set(self, user_id: int, is_member: bool):
+        self.box.set(user_id, "member", is_member)
+
+    def joined(self, user_id: int):
+        self.set(user_id, True)
+
+    def left(self, user_id: int):
+        self.set(user_id, False)
+
+
+chat_members = ChatMembers(config.CHAT_MEMBERS_CACHE_MAX_SIZE, config.CHAT_MEMBERS_CACHE_TTL)
@@ -19,6 +19,7 @@ logging.basicConfig(level=logging.INFO, filename=config.LOG_FILENAME)
 bot = Bot(token=config.BOT_TOKEN)
 dp = Dispatcher(bot)
 storage = db.Storage(dp.loop)
+dp.middleware.setup(tg.QueryCountMiddleware(storage))
 temp_storage = entities.TempStorage()
 lock_market = asyncio.Lock()
 
@@ -27,7 +28,7 @@ COMMANDS = ["start", "help", "hug", "bank", "unbank", "mybank", "coins", "users"
             "report", "fees", "top", "worst", "stop", "test", "topbanks", "casino",
             "sell", "buy", "market", "deletereports", "myid", "profile",
             "creategroup", "mygroup", "renamegroup", "invite", "grouptax", "removemember", "sendcrystals",
-            "hack", "anoncode", "msg", "changebank", "ad", "random"]
+            "hack", "anoncode", "msg", "changebank", "ad", "random", "dbstats"]
 HTML = "html"
 
 
@@ -45,7 +46,7 @@ async def message_func(message: types.Message):
         if user.user_id == config.ANON_BOT_ID:
             return
 
-        await user.load_from_db()
+        await user.touch(message.chat.id, bot=bot)
 
         availability = await tg.check_availability(bot, message, user)
         if not availability.result:
@@ -53,8 +54,6 @@ async def message_func(message: types.Message):
                 await message.delete()
             return
 
-        await user.update()
-
         if cm in ('/start', '/help', '/fees'):
             await tg.help_menu(message)
 
@@ -175,9 +174,8 @@ async def message_func(message: types.Message):
 
         # Беднейшие пользователи по балансу.
         elif cm == "/worst":
-            users_count = await storage.get_users_count(include_muted=True)
-            balances = await storage.get_worst_balances()
-            balances.reverse()
+            users_count = await storage.get_rated_users_count()
+            balances = list(reversed(await storage.get_worst_balances()))
 
             text = "🤕 <b>Самые бедные участники</b>\n"
             for idx, balance in enumerate(balances):
@@ -189,6 +187,7 @@ async def message_func(message: types.Message):
         # Остановка бота.
         elif cm == "/stop" and user.user_id == config.ADMIN_ID:
             await message.answer("⏹️ Остановка Бота")
+            await storage.flush_balance_deltas()
             dp.stop_polling()
             asyncio.get_event_loop().stop()
             sys.exit()
@@ -197,18 +196,44 @@ async def message_func(message: types.Message):
         elif cm == "/test" and user.user_id == config.ADMIN_ID:
             print()
 
-        # Топ пользователей по балансу.
-        elif cm == "/top":
-            balance_task = asyncio.create_task(storage.get_top_balances())
-            crystal_balance_task = asyncio.create_task(storage.get_top_crystal_balances())
-            total_market_crystals_task = asyncio.create_task(storage.get_market_total_crystals())
-            top_groups_task = asyncio.create_task(storage.get_top_groups())
+        # Статистика работы с БД.
+        elif cm == "/dbstats" and user.user_id == config.ADMIN_ID:
+            pool_info = storage.get_pool_info()
+            text = "🗄 <b>Пул соединений</b>\n" + "\n".join([f"{k}: <code>{v}</code>" for k, v in pool_info.items()])
+
+            query_stats = storage.query_stats
+            text += "\n\n⏱ <b>Запросы по методам</b> (вызовы | сред. | p95 | макс. мс | строк)"
+            for site, info in query_stats.top_sites():
+                p95 = query_stats.percentile_ms(site, 95)
+                text += (f"\n<code>{site}</code>: {info['calls']} | {info['total_ms'] / info['calls']:.1f} | "
+                         f"{'≤' + str(p95) if p95 else '>1000'} | {info['max_ms']:.1f} | {info['rows']}")
+            text += (f"\nОбщих запросов: <code>{query_stats.flights}</code>, "
+                     f"присоединений: <code>{query_stats.shared_flights}</code>")
+
+            text += "\n\n👤 <b>Кэш пользователей</b>\n" + "\n".join(
+                [f"{k}: <code>{v}</code>" for k, v in storage.user_cache.get_info().items()])
+            text += "\n\n👥 <b>Кэш групп</b>\n" + "\n".join(
+                [f"{k}: <code>{v}</code>" for k, v in storage.group_cache.get_info().items()])
+            text += "\n\n🗃 <b>Временные значения</b>\n" + "\n".join(
+                [f"{k}: <code>{v}</code> / <code>{temp_storage.box.get_info()[k]}</code>"
+                 for k, v in storage.local.get_info().items()])
+
+            text += "\n\n📨 <b>Запросов на обновление</b> (обновлений | сред. | макс.)"
+            for label, info in query_stats.top_updates():
+                text += (f"\n<code>{label}</code>: {info['updates']} | "
+                         f"{info['queries'] / info['updates']:.1f} | {info['max_queries']}")
 
-            balances = await balance_task
-            crystal_balances = await crystal_balance_task
+            await message.answer(text, parse_mode=HTML)
 
-            total_market_crystals = await total_market_crystals_task
-            top_groups = await top_groups_task
+        # Топ пользователей по балансу.
+        elif cm == "/top":
+            # Рейтинги поддерживаются в памяти и всегда актуальны.
+            balances, crystal_balances, total_market_crystals, top_groups = await asyncio.gather(
+                storage.get_top_balances(),
+                storage.get_top_crystal_balances(),
+                storage.get_market_total_crystals(),
+                storage.get_top_groups()
+            )
 
             total_balance = int(sum(balances))
             total_top_balance = int(sum(balances[:10]))
@@ -538,7 +563,7 @@ async def message_func(message: types.Message):
         # Просмотр топа банковских счетов.
         elif cm == "/topbanks":
             try:
-                banks = await storage.get_top_banks()
+                banks = await storage.get_top_n_banks(10)
 
                 if banks:
                     text = "💰 <b>Топ банковских счетов</b>"
@@ -763,15 +788,13 @@ async def handle_media(message: types.Message):
         if user.user_id == config.ANON_BOT_ID:
             return
 
-        await user.load_from_db()
+        await user.touch(message.chat.id, bot=bot)
 
         availability = await tg.check_availability(bot, message, user)
         if not availability.result:
             if availability.delete:
                 await message.delete()
             return
-
-        await user.update()
         await tg.check_bad_habits(message, user)
     except Exception as e:
         print(f"TXT E: {e}")
@@ -786,15 +809,13 @@ async def handle_message(message: types.Message):
         if user.user_id == config.ANON_BOT_ID:
             return
 
-        await user.load_from_db()
+        await user.touch(message.chat.id, bot=bot)
 
         availability = await tg.check_availability(bot, message, user)
         if not availability.result:
             if availability.delete:
                 await message.delete()
             return
-
-        await user.update()
         await tg.check_bad_habits(message, user)
     except Exception as e:
         print(f"TXT E: {e}")
@@ -812,14 +833,12 @@ async def inline_touch(call: types.CallbackQuery):
         if user.user_id == config.ANON_BOT_ID:
             return
 
-        await user.load_from_db()
+        await user.touch(call.message.chat.id, require_agreed=False, bot=bot)
 
         availability = await tg.check_availability(bot, call.message, user, call=call, ignore_agree=True)
         if not availability.result:
             return
 
-        await user.update()
-
         if config.DEBUG_MODE:
             print(f"CALL.DATA: {call.data}")
 
@@ -1024,6 +1043,7 @@ async def user_join_request(update: types.ChatJoinRequest):
             await update.decline()
         else:
             await update.approve()
+            entities.chat_members.joined(user.user_id)
             # Создаем запись в БД.
             await user.update()
 
@@ -1042,6 +1062,9 @@ async def user_joined_chat(message: types.Message):
         if message.chat.id != config.CHAT_ID:
             return
 
+        for new_member in message.new_chat_members:
+            entities.chat_members.joined(new_member.id)
+
         user = entities.User(storage, **utils.unpack_message(message))
 
         if user.user_id == config.ANON_BOT_ID:
@@ -1053,6 +1076,7 @@ async def user_joined_chat(message: types.Message):
             # Если пользователь заблокирован в БД.
             if user.banned:
                 # Блокируем его в чате.
+                entities.chat_members.left(user.user_id)
                 await bot.ban_chat_member(config.CHAT_ID, user.user_id)
                 return
         try:
@@ -1078,6 +1102,7 @@ async def user_left_chat(message: types.Message):
             return
 
         user_id = message.left_chat_member.id
+        entities.chat_members.left(user_id)
         user = entities.User(storage, user_id)
         await user.load_from_db()
 
@@ -1133,6 +1158,12 @@ async def process_chat_tasks():
             if config.DEBUG_MODE:
                 print("updated")
 
+            if can_process("purge_local", 600):
+                # Удаляем истекшие временные значения.
+                storage.local.purge_expired()
+                temp_storage.box.purge_expired()
+                storage.cooldowns.purge(datetime.datetime.now())
+
             if can_process("clear_inactive", 600) and not config.DEBUG_MODE:
                 # Чистим от неактивных пользователей.
                 await tg.clear_from_inactive_users(bot, storage)
@@ -1159,23 +1190,20 @@ async def process_chat_tasks():
                     # Отмечаем новое время.
                     await storage.update_temp_storage("lastPaying", int(now.timestamp()))
 
-                    # Получаем список пользователей.
-                    users = await storage.get_users()
+                    # Считаем пользователей на стороне БД, сам список читается постранично.
+                    summary = await storage.get_daily_fee_summary()
                     good = 0
                     bad = 0
                     paid = 0
 
-                    users_will_bad = [1 for u in users if
-                                      u['balance'] and u['balance'] < config.PRICE_CHAT_DAILY and not u['team_id']]
-
                     text = ("☢️ <b>Вот-вот начнётся чистка</b>\n"
-                            f"Участников будет проверено: <b>{len(users)}</b>\n"
-                            f"Будет удалено: <b>~{len(users_will_bad)}</b>\n\n"
+                            f"Участников будет проверено: <b>{summary['total']}</b>\n"
+                            f"Будет удалено: <b>~{summary['will_bad']}</b>\n\n"
                             f"У вас есть 10 секунд перед её началом. По всем вопросам: @reireireime")
                     await bot.send_message(config.CHAT_ID, text, parse_mode=HTML)
                     await asyncio.sleep(10)
 
-                    for user_note in users:
+                    async for user_note in storage.iter_users():
                         try:
                             user = entities.User(storage, user_note["user_id"], user_note["username"],
                                                  user_note["first_name"], user_note["last_name"])
@@ -1199,6 +1227,7 @@ async def process_chat_tasks():
                                 # Исключаем пользователя.
                                 await user.ban()
                                 try:
+                                    entities.chat_members.left(user.user_id)
                                     await bot.ban_chat_member(config.CHAT_ID, user.user_id)
                                 except:
                                     pass
@@ -1461,8 +1490,29 @@ async def process_chat_tasks():
 async def start_chat_tasks(_):
     global BOT_PROFILE
     BOT_PROFILE = await bot.get_me()
+    # Пул создается заранее, чтобы первые сообщения не ждали подключения к БД.
+    await storage.create_pool()
+    # Кд обнимашек, жалоб и опросов проверяются по индексу в памяти.
+    await storage.load_cooldowns()
+    # Неактивные пользователи ищутся по времени активности в памяти.
+    await storage.load_last_seen()
+    # Топ и антитоп поддерживаются в памяти событиями изменения балансов.
+    await storage.load_rankings()
     asyncio.create_task(process_chat_tasks())
+    # Рейтинги пересчитываются в фоне.
+    asyncio.create_task(storage.process_rankings())
+
+    if config.BALANCE_BUFFER_ENABLED:
+        asyncio.create_task(storage.process_balance_deltas())
+    if config.ACTIVITY_BUFFER_ENABLED:
+        asyncio.create_task(storage.process_activity())
+
+
+async def stop_chat_tasks(_):
+    # Записываем в БД накопленные изменения балансов.
+    await storage.flush_balance_deltas()
+    await storage.close_pool()
 
 
 if __name__ == '__main__':
-    executor.start_polling(dp, on_startup=start_chat_tasks)
+    executor.start_polling(dp, on_startup=start_chat_tasks, on_shutdown=stop_chat_tasks)
@@ -5,6 +5,7 @@ import datetime
 import aiofiles
 import aiogram
 from aiogram import Bot, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
 
 import config
 import utils
@@ -17,6 +18,31 @@ HTML = "html"
 lock_market = asyncio.Lock()
 
 
+class QueryCountMiddleware(BaseMiddleware):
+    """Считает количество запросов к БД, выполненных при обработке одного обновления."""
+    def __init__(self, storage: db.Storage):
+        super().__init__()
+        self.storage = storage
+
+    @staticmethod
+    def get_label(update: types.Update) -> str:
+        if update.message and update.message.text and update.message.text.startswith("/"):
+            return update.message.text.split()[0].split("@")[0]
+        if update.callback_query and update.callback_query.data:
+            return "call:" + update.callback_query.data.split("_")[0]
+        if update.message:
+            return "message"
+        return "other"
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        db.update_queries.set([0])
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        counter = db.update_queries.get()
+        if counter is not None:
+            self.storage.query_stats.record_update(self.get_label(update), counter[0])
+
+
 async def notify(bot: aiogram.Bot, text: str):
     try:
         if config.LOGS_CHANNEL_ID:
@@ -670,14 +696,14 @@ async def removing_user_from_group(event: types.Message | types.CallbackQuery, u
 
         to_user = await search_user(user.get_storage(), event, to_user_id, True, bot_profile)
         if to_user:
-            # Исключаем участника группы.
-            await to_user.exit_group(group.group_id)
-
             if not (await group.is_member(to_user.user_id)):
                 text = "❌ Выбранный пользователь не состоит в вашей группе"
                 await event.answer(text, show_alert=True)
                 return
 
+            # Исключаем участника группы.
+            await to_user.exit_group(group.group_id)
+
             # Оповещаем лидера.
             text = f"☑️ <b>Участник исключен</b>\n{to_user}"
             await event.message.edit_text(text, parse_mode=HTML)
@@ -1249,6 +1275,7 @@ async def clear_from_disagreed_users(bot: aiogram.Bot, storage: db.Storage):
                 await user.load_from_db()
                 await user.ban()
                 try:
+                    entities.chat_members.left(user_id)
                     await bot.ban_chat_member(config.CHAT_ID, user_id)
                 except:
                     pass
@@ -1293,6 +1320,7 @@ async def clear_from_inactive_users(bot: aiogram.Bot, storage: db.Storage):
                 await user.load_from_db()
                 await user.ban()
                 try:
+                    entities.chat_members.left(user_id)
                     await bot.ban_chat_member(config.CHAT_ID, user_id)
                 except:
                     pass
@@ -1360,9 +1388,8 @@ async def process_vote(call: types.CallbackQuery, user: entities.User):
         await call.answer(text_error, show_alert=True)
         return
 
-    # Пробуем получить текущий голос, если он уже существует.
-    user_vote = await user.get_vote(poll_id, stage)
-    if user_vote:
+    # Проверяем, голосовал ли уже пользователь.
+    if await user.has_voted(poll_id, stage):
         text_error = "❌ Вы уже голосовали"
         await call.answer(text_error, show_alert=True)
 
@@ -1514,6 +1541,7 @@ async def process_vote(call: types.CallbackQuery, user: entities.User):
                 await call.message.answer(text_result, parse_mode=HTML)
 
                 await to_user.ban()
+                entities.chat_members.left(to_user.user_id)
                 await call.message.bot.ban_chat_member(config.CHAT_ID, to_user.user_id)
 
                 # Уведомляем обвиняемого.
@@ -2355,6 +2383,10 @@ async def check_availability(bot: Bot, action: types.Message, user: entities.Use
         return entities.AvailabilityReport(result=False)
     in_chat = (now_chat_id == config.CHAT_ID)
 
+    # Сообщение из чата подтверждает, что пользователь в нем состоит.
+    if in_chat and not call:
+        entities.chat_members.joined(user.user_id)
+
     # Если пользователя нет в БД и он написал в лс.
     if not await user.exists():
         if in_chat:
@@ -2375,6 +2407,7 @@ async def check_availability(bot: Bot, action: types.Message, user: entities.Use
     if user.banned:
         if in_chat:
             # Если это чат, то баним пользователя в чате.
+            entities.chat_members.left(user.user_id)
             await bot.ban_chat_member(config.CHAT_ID, user.user_id)
             text = f"⛔ Пользователь <code>{user.user_id}</code> исключен"
             await action.answer(text, parse_mode=HTML)
@@ -2413,6 +2446,7 @@ async def check_availability(bot: Bot, action: types.Message, user: entities.Use
             # Если прошло больше заданного времени, то блокируем пользователя.
             if now_time.timestamp() - user.created.timestamp() > config.TIME_TO_AGREED:
                 await user.ban()
+                entities.chat_members.left(user.user_id)
                 await bot.ban_chat_member(config.CHAT_ID, user.user_id)
 
                 if in_chat:
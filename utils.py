@@ -1,5 +1,6 @@
 import re
 import random
+import typing
 
 import datetime
 from PIL import Image, ImageDraw, ImageFont
@@ -7,6 +8,12 @@ from aiogram import types
 
 import config
 
+try:
+    import numpy
+except ImportError:
+    # Без NumPy суммы счетов считаются обычным циклом.
+    numpy = None
+
 
 def format_time(from_time: datetime.datetime | int) -> str:
     if not from_time:
@@ -85,13 +92,76 @@ def convert_command(message: types.Message):
             message.text = command.split("@")[0] + message.text.replace(command, "", 1)
 
 
-def calc_bank_balance(balance: int, user_percent: int, opened: datetime.datetime) -> int:
-    now = datetime.datetime.now()
+def calc_bank_balance(balance: int, user_percent: int, opened: datetime.datetime,
+                      now: datetime.datetime | None = None) -> int:
+    now = now or datetime.datetime.now()
     seconds = int(now.timestamp() - opened.timestamp())
 
     return int(balance * (1 + user_percent / 100) ** (seconds / 86400))
 
 
+def calc_bank_balances(balances: typing.Sequence[int], user_percents: typing.Sequence[int],
+                       opened: typing.Sequence[datetime.datetime], now: datetime.datetime | None = None) -> list[int]:
+    """
+    Текущие суммы нескольких счетов (как calc_bank_balance) на один общий момент времени.
+    С NumPy считаются за один векторный проход, без него - циклом.
+    """
+    now = now or datetime.datetime.now()
+    now_timestamp = now.timestamp()
+    seconds = [int(now_timestamp - opened_time.timestamp()) for opened_time in opened]
+
+    if numpy is not None and seconds:
+        values = (numpy.asarray(balances, dtype=numpy.float64) *
+                  (1 + numpy.asarray(user_percents, dtype=numpy.float64) / 100) **
+                  (numpy.asarray(seconds, dtype=numpy.float64) / 86400))
+        # Слишком большие суммы не помещаются в int64 - их считаем без NumPy.
+        if numpy.all(numpy.abs(values) < 2 ** 62):
+            return values.astype(numpy.int64).tolist()
+
+    return [int(balance * (1 + user_percent / 100) ** (s / 86400))
+            for balance, user_percent, s in zip(balances, user_percents, seconds)]
+
+
+def sum_banks_by_owner(banks: typing.Iterable[dict]) -> dict[int, int]:
+    """Суммы счетов (unbankSum) по владельцам."""
+    totals = {}
+    for bank in banks:
+        owner_id = bank["user_id"]
+        totals[owner_id] = totals.get(owner_id, 0) + bank["unbankSum"]
+    return totals
+
+
+def add_banks_to_balances(users: list[dict], banks: typing.Iterable[dict]):
+    """Прибавляет к балансам пользователей (записи с user_id и balance) суммы их счетов."""
+    totals = sum_banks_by_owner(banks)
+    for user_note in users:
+        user_note["balance"] = int(user_note["balance"] + totals.get(user_note["user_id"], 0))
+
+
+def sum_group_balances(members: typing.Iterable[tuple[int, int, int, int]],
+                       banks: typing.Iterable[dict]) -> dict[int, dict]:
+    """
+    Балансы групп с учетом счетов участников.
+    :param members: (user_id, group_id, balance, crystals) участников групп.
+    :return: {group_id: {"members": количество участников, "balance": ..., "crystals": ...}}
+    """
+    totals = sum_banks_by_owner(banks)
+    groups = {}
+    for user_id, group_id, balance, crystals in members:
+        group = groups.get(group_id)
+        if group is None:
+            group = groups[group_id] = {
+                "members": 0,
+                "balance": 0,
+                "crystals": 0
+            }
+
+        group["members"] += 1
+        group["balance"] += balance + totals.get(user_id, 0)
+        group["crystals"] += crystals
+    return groups
+
+
 def follow_cooldown(from_time: datetime.datetime | int | None, cooldown_seconds: int) -> bool:
     if from_time is None:
         return True